@@ -0,0 +1,190 @@
+import argparse
+import base64
+import datetime
+import math
+import random
+import sys
+from xml.sax.saxutils import quoteattr
+
+# Synthetic "SMS Backup & Restore" XML for benchmarking the scripts in this repository.
+# The output only depends on the options and the seed, so the same command always
+# produces the same file.
+
+# Start of the generated conversation history, and the average gap between messages
+START_DATE = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+MESSAGE_INTERVAL_MS = 90 * 60 * 1000
+
+# Attachments re-sent in a conversation are picked from its most recent ones
+RECENT_ATTACHMENTS = 8
+
+WORDS = ("ok", "yes", "no", "thanks", "see", "you", "soon", "running", "late", "lunch", "tomorrow",
+         "call", "me", "when", "home", "love", "it", "haha", "photo", "from", "the", "trip", "where",
+         "are", "we", "meeting", "sounds", "good", "on", "my", "way", "happy", "birthday")
+
+# Emoji written as UTF-16 surrogate pairs, one numeric entity per half, the way the
+# app writes them. These are not valid XML until xml-fixer/xml-entity-fixer.py is run.
+SURROGATE_EMOJI = ("&#55357;&#56832;", "&#55357;&#56860;", "&#55357;&#56397;", "&#55358;&#56611;", "&#55356;&#57225;")
+EMOJI = ("\U0001F600", "\U0001F61C", "\U0001F44D", "\U0001F923", "\U0001F389")
+
+FIRST_NAMES = ("Alice", "Bob", "Carol", "Dave", "Erin", "Frank", "Grace", "Heidi", "Ivan", "Judy",
+               "Mallory", "Niaj", "Olivia", "Peggy", "Rupert", "Sybil", "Trent", "Victor", "Walter", "Zoe")
+
+def parse_size(value):
+    # A byte count with an optional K, M or G suffix (powers of 1024)
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    number = value.strip().upper().rstrip('B')
+    scale = 1
+    if number and number[-1] in units:
+        scale = units[number[-1]]
+        number = number[:-1]
+    try:
+        return int(float(number) * scale)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size '%s', expected e.g. 200K or 2M" % value)
+
+def parse_fraction(value):
+    try:
+        fraction = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid fraction '%s'" % value)
+    if not 0 <= fraction <= 1:
+        raise argparse.ArgumentTypeError("fraction must be between 0 and 1")
+    return fraction
+
+class BackupGenerator:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.contacts = [("%s %s" % (self.rng.choice(FIRST_NAMES), chr(ord('A') + i % 26)), "+1555%07d" % (1000000 + i))
+                         for i in range(args.contacts)]
+        # Group chats of 3 to 5 contacts, drawn once so conversations repeat
+        self.groups = []
+        for _ in range(max(1, args.contacts // 4)):
+            self.groups.append(self.rng.sample(self.contacts, min(len(self.contacts), self.rng.randint(3, 5))))
+        self.recent = {}
+        self.attachment_count = 0
+        self.attachment_bytes = 0
+        self.duplicate_count = 0
+
+    def attachment_size(self, video):
+        # Log-normal around the median, so most attachments are small with a long tail
+        median = self.args.video_median if video else self.args.image_median
+        size = int(median * math.exp(self.rng.gauss(0, self.args.size_sigma)))
+        return max(64, min(size, self.args.attachment_max))
+
+    def text(self):
+        words = [self.rng.choice(WORDS) for _ in range(self.rng.randint(1, 12))]
+        text = quoteattr(" ".join(words).capitalize())
+        if self.rng.random() < self.args.surrogate_density:
+            position = self.rng.randint(1, len(text) - 1)
+            text = text[:position] + self.rng.choice(SURROGATE_EMOJI) + text[position:]
+        elif self.rng.random() < self.args.emoji_density:
+            text = text[:-1] + " " + self.rng.choice(EMOJI) + text[-1]
+        return text
+
+    def attachment(self, conversation):
+        # Returns (content type, file name, base64 data)
+        recent = self.recent.setdefault(conversation, [])
+        self.attachment_count += 1
+        if recent and self.rng.random() < self.args.duplicate_rate:
+            self.duplicate_count += 1
+            return self.rng.choice(recent)
+        video = self.rng.random() < self.args.video_share
+        size = self.attachment_size(video)
+        self.attachment_bytes += size
+        if video:
+            content_type, name = "video/mp4", "VID_%06d.mp4" % self.attachment_count
+        else:
+            content_type, name = "image/jpeg", "IMG_%06d.jpg" % self.attachment_count
+        attachment = (content_type, name, base64.b64encode(self.rng.randbytes(size)).decode('ascii'))
+        recent.append(attachment)
+        if len(recent) > RECENT_ATTACHMENTS:
+            del recent[0]
+        return attachment
+
+    def readable_date(self, date):
+        return datetime.datetime.fromtimestamp(date / 1000, datetime.timezone.utc).strftime("%b %d, %Y %I:%M:%S %p")
+
+    def sms(self, out, date):
+        name, address = self.rng.choice(self.contacts)
+        out.write('  <sms protocol="0" address="%s" date="%d" type="%d" subject="null" body=%s toa="null" '
+                  'sc_toa="null" service_center="null" read="1" status="-1" locked="0" date_sent="%d" '
+                  'sub_id="1" readable_date="%s" contact_name=%s />\n'
+                  % (address, date, self.rng.choice((1, 2)), self.text(), date - self.rng.randint(0, 5000),
+                     self.readable_date(date), quoteattr(name)))
+
+    def mms(self, out, date):
+        if self.rng.random() < self.args.group_share:
+            members = self.rng.choice(self.groups)
+        else:
+            members = [self.rng.choice(self.contacts)]
+        address = "~".join(number for _, number in members)
+        contact_name = ", ".join(name for name, _ in members)
+        msg_box = self.rng.choice((1, 2))
+        out.write('  <mms date="%d" ct_t="application/vnd.wap.multipart.related" msg_box="%d" rr="null" sub="null" '
+                  'read_status="null" address="%s" m_id="null" read="1" m_size="null" m_type="%d" sim_slot="0" '
+                  'readable_date="%s" contact_name=%s>\n'
+                  % (date, msg_box, address, 132 if msg_box == 1 else 128, self.readable_date(date), quoteattr(contact_name)))
+        out.write('    <parts>\n')
+        out.write('      <part seq="-1" ct="application/smil" name="null" chset="null" cd="null" fn="null" cid="&lt;smil&gt;" '
+                  'cl="smil.xml" ctt_s="null" ctt_t="null" text="&lt;smil&gt;&lt;body&gt;&lt;/body&gt;&lt;/smil&gt;" />\n')
+        for _ in range(1 + (self.rng.random() < 0.2)):
+            content_type, name, data = self.attachment(address)
+            out.write('      <part seq="0" ct="%s" name="%s" chset="null" cd="null" fn="null" cid="&lt;%s&gt;" cl="%s" '
+                      'ctt_s="null" ctt_t="null" text="null" data="%s" />\n' % (content_type, name, name, name, data))
+        if self.rng.random() < 0.5:
+            out.write('      <part seq="0" ct="text/plain" name="null" chset="106" cd="null" fn="null" cid="&lt;text&gt;" '
+                      'cl="text.txt" ctt_s="null" ctt_t="null" text=%s />\n' % self.text())
+        out.write('    </parts>\n    <addrs>\n')
+        for _, number in members:
+            out.write('      <addr address="%s" type="%d" charset="106" />\n' % (number, 151 if msg_box == 2 else 137))
+        out.write('    </addrs>\n  </mms>\n')
+
+    def write(self, out):
+        date = int(START_DATE.timestamp() * 1000)
+        out.write("<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>\n")
+        out.write('<smses count="%d" backup_set="%08x" backup_date="%d" type="full">\n'
+                  % (self.args.messages, self.rng.getrandbits(32), date))
+        for _ in range(self.args.messages):
+            date += self.rng.randint(1, 2 * MESSAGE_INTERVAL_MS)
+            if self.rng.random() < self.args.mms_share:
+                self.mms(out, date)
+            else:
+                self.sms(out, date)
+        out.write('</smses>\n')
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic SMS Backup & Restore XML file for benchmarks")
+    parser.add_argument("output_file", help="Output XML file, or - for standard output")
+    parser.add_argument("--messages", type=int, default=10000, help="Number of SMS and MMS records (default: 10000)")
+    parser.add_argument("--mms-share", type=parse_fraction, default=0.2, help="Fraction of records that are MMS (default: 0.2)")
+    parser.add_argument("--video-share", type=parse_fraction, default=0.1, help="Fraction of attachments that are videos (default: 0.1)")
+    parser.add_argument("--image-median", type=parse_size, default=parse_size("150K"), help="Median image size (default: 150K)")
+    parser.add_argument("--video-median", type=parse_size, default=parse_size("2M"), help="Median video size (default: 2M)")
+    parser.add_argument("--size-sigma", type=float, default=0.8, help="Spread of the log-normal attachment sizes (default: 0.8)")
+    parser.add_argument("--attachment-max", type=parse_size, default=parse_size("20M"), help="Largest attachment (default: 20M)")
+    parser.add_argument("--duplicate-rate", type=parse_fraction, default=0.15,
+                        help="Fraction of attachments that re-send one already sent in the same conversation (default: 0.15)")
+    parser.add_argument("--group-share", type=parse_fraction, default=0.1, help="Fraction of MMS sent to group chats (default: 0.1)")
+    parser.add_argument("--contacts", type=int, default=40, help="Number of contacts (default: 40)")
+    parser.add_argument("--emoji-density", type=parse_fraction, default=0.1,
+                        help="Fraction of message texts with an emoji written as UTF-8 (default: 0.1)")
+    parser.add_argument("--surrogate-density", type=parse_fraction, default=0.0,
+                        help="Fraction of message texts with an emoji written as surrogate pair entities, "
+                             "which only xml-entity-fixer.py can read (default: 0)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    args = parser.parse_args()
+    if args.contacts < 1 or args.messages < 0:
+        parser.error("--contacts must be at least 1 and --messages can't be negative")
+
+    generator = BackupGenerator(args)
+    if args.output_file == "-":
+        generator.write(sys.stdout)
+    else:
+        with open(args.output_file, "w", encoding="utf-8", newline="\n") as out:
+            generator.write(out)
+    print("Attachments: %d (%d duplicates), %.1f MB before encoding" % (
+        generator.attachment_count, generator.duplicate_count, generator.attachment_bytes / (1024 * 1024)), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
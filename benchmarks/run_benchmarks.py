@@ -0,0 +1,213 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Runs the scripts in this repository on synthetic backups from generate_backup.py
+# and records wall time, peak RSS and MB/s of input as JSON, so results from two
+# commits can be compared with --compare.
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+GENERATOR = os.path.join(BENCHMARK_DIR, "generate_backup.py")
+
+# Smaller attachments than the generator defaults, so a run takes minutes rather than hours
+GENERATOR_ARGS = ["--image-median", "100K", "--video-median", "1M", "--attachment-max", "8M"]
+
+# The second input of the merger benchmark has this many more messages than the first.
+# Both come from the same seed, so the first file's messages are all duplicates.
+MERGE_OVERLAP = 1.25
+
+# For each tool: the script, its option for the number of workers (None if it has
+# none) and a function returning (inputs, command) for an input set and work folder.
+TOOLS = {
+    "extractor": {
+        "script": os.path.join(REPO_DIR, "smsbackuprestore-extractor.py"),
+        "threads_option": "--threads",
+        "command": lambda script, files, out: ([files["clean"]], [script, files["clean"], os.path.join(out, "media"), "--huge-tree"]),
+    },
+    "merger": {
+        "script": os.path.join(REPO_DIR, "xml-merger", "merge.py"),
+        "threads_option": "--workers",
+        "command": lambda script, files, out: ([files["clean"], files["overlap"]],
+                                               [script, "-i", files["clean"], files["overlap"], "-o", os.path.join(out, "merged.xml"),
+                                                "--db-file", os.path.join(out, "merge.db")]),
+    },
+    "fixer": {
+        "script": os.path.join(REPO_DIR, "xml-fixer", "xml-entity-fixer.py"),
+        "threads_option": "--jobs",
+        "command": lambda script, files, out: ([files["surrogates"]], [script, files["surrogates"], os.path.join(out, "fixed.xml")]),
+    },
+}
+
+def parse_list(value, item_type=str):
+    try:
+        return [item_type(item) for item in value.split(",") if item.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid list '%s'" % value)
+
+def generate(output_file, messages, seed, extra_args):
+    if os.path.exists(output_file):
+        # Same options and seed, same file
+        return
+    command = [sys.executable, GENERATOR, output_file + ".tmp", "--messages", str(messages), "--seed", str(seed)]
+    subprocess.run(command + GENERATOR_ARGS + extra_args, check=True, stderr=subprocess.DEVNULL)
+    os.replace(output_file + ".tmp", output_file)
+
+def generate_inputs(work_dir, messages, seed, extra_args):
+    files = {"clean": os.path.join(work_dir, "backup-%d.xml" % messages),
+             "overlap": os.path.join(work_dir, "backup-%d-overlap.xml" % messages),
+             "surrogates": os.path.join(work_dir, "backup-%d-surrogates.xml" % messages)}
+    generate(files["clean"], messages, seed, extra_args)
+    generate(files["overlap"], int(messages * MERGE_OVERLAP), seed, extra_args)
+    generate(files["surrogates"], messages, seed, extra_args + ["--surrogate-density", "0.05"])
+    return files
+
+def run_command(command, cwd):
+    # Returns (wall seconds, peak RSS in bytes or None, exit code, error output). The
+    # peak RSS is that of the script's own process; worker processes started through
+    # a fork server are not included.
+    with tempfile.TemporaryFile(dir=cwd) as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable] + command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=stderr)
+        if hasattr(os, "wait4"):
+            _, status, usage = os.wait4(process.pid, 0)
+            wall = time.perf_counter() - start
+            process.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in kilobytes, except on macOS
+            peak_rss = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        else:
+            process.wait()
+            wall = time.perf_counter() - start
+            peak_rss = None
+        stderr.seek(0)
+        return wall, peak_rss, process.returncode, stderr.read().decode("utf-8", "replace")
+
+def run_case(tool, files, threads, repeat, work_dir):
+    settings = TOOLS[tool]
+    walls = []
+    peak_rss = None
+    for _ in range(repeat):
+        out = tempfile.mkdtemp(prefix=tool + "-", dir=work_dir)
+        try:
+            inputs, command = settings["command"](settings["script"], files, out)
+            if threads is not None:
+                command += [settings["threads_option"], str(threads)]
+            wall, rss, exit_code, stderr = run_command(command, out)
+        finally:
+            shutil.rmtree(out, ignore_errors=True)
+        if exit_code != 0:
+            print("%s failed with exit code %d:\n%s" % (tool, exit_code, stderr), file=sys.stderr)
+            return {"tool": tool, "threads": threads, "exit_code": exit_code}
+        walls.append(wall)
+        if rss is not None:
+            peak_rss = max(peak_rss or 0, rss)
+    input_bytes = sum(os.path.getsize(f) for f in inputs)
+    wall = min(walls)
+    return {"tool": tool, "threads": threads, "exit_code": 0, "input_bytes": input_bytes,
+            "wall_seconds": round(wall, 3), "wall_seconds_runs": [round(w, 3) for w in walls],
+            "peak_rss_bytes": peak_rss, "mb_per_s": round(input_bytes / wall / 1e6, 3)}
+
+def get_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+def case_key(result):
+    return (result["tool"], result["messages"], result["threads"])
+
+def compare(results, baseline_file, threshold):
+    # Prints the change in wall time of each case also in the baseline. Returns the
+    # number of cases more than threshold percent slower.
+    with open(baseline_file, encoding="utf-8") as f:
+        baseline = {case_key(r): r for r in json.load(f)["results"] if r.get("exit_code") == 0}
+    regressions = 0
+    print("%-10s %9s %7s %10s %10s %8s" % ("Tool", "Messages", "Threads", "Before", "After", "Change"))
+    for result in results:
+        before = baseline.get(case_key(result))
+        if before is None or result.get("exit_code") != 0:
+            continue
+        change = 100.0 * (result["wall_seconds"] - before["wall_seconds"]) / before["wall_seconds"]
+        flag = ""
+        if change > threshold:
+            regressions += 1
+            flag = "  slower"
+        print("%-10s %9d %7s %9.2fs %9.2fs %+7.1f%%%s" % (result["tool"], result["messages"], result["threads"] or "-",
+                                                        before["wall_seconds"], result["wall_seconds"], change, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the scripts in this repository on synthetic backups")
+    parser.add_argument("--tools", type=parse_list, default=list(TOOLS),
+                        help="Comma-separated tools to run: %s (default: all)" % ", ".join(TOOLS))
+    parser.add_argument("--sizes", type=lambda v: parse_list(v, int), default=[1000, 5000],
+                        help="Comma-separated message counts of the generated backups (default: 1000,5000)")
+    parser.add_argument("--threads", type=lambda v: parse_list(v, int), default=[1, 2, 4],
+                        help="Comma-separated worker counts, for the tools that have one (default: 1,2,4)")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of each case; the fastest is reported (default: 1)")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the generated backups (default: 1)")
+    parser.add_argument("--generator-args", type=shlex.split, default=[],
+                        help='Extra options for generate_backup.py, e.g. "--mms-share 0.5 --duplicate-rate 0.3"')
+    parser.add_argument("--work-dir", default=None,
+                        help="Folder for the generated backups, kept between runs (default: a temporary folder)")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="Results file (default: benchmark_results.json)")
+    parser.add_argument("--compare", default=None, help="Earlier results file to compare wall times with")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="With --compare, percent slowdown reported as a regression; exits with status 1 if any (default: 10)")
+    args = parser.parse_args()
+    unknown = [tool for tool in args.tools if tool not in TOOLS]
+    if unknown:
+        parser.error("unknown tool(s): %s" % ", ".join(unknown))
+
+    # Absolute, as each script runs in its own folder inside it
+    work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix="sms-benchmarks-"))
+    os.makedirs(work_dir, exist_ok=True)
+    results = []
+    try:
+        for messages in args.sizes:
+            print("Generating backups with %d messages..." % messages, file=sys.stderr)
+            files = generate_inputs(work_dir, messages, args.seed, args.generator_args)
+            for tool in args.tools:
+                thread_counts = args.threads if TOOLS[tool]["threads_option"] else [None]
+                for threads in thread_counts:
+                    result = run_case(tool, files, threads, max(1, args.repeat), work_dir)
+                    result["messages"] = messages
+                    results.append(result)
+                    if result["exit_code"] == 0:
+                        print("%-10s %7d messages %5s threads: %8.2fs %8.1f MB/s %8s MB peak RSS" % (
+                            tool, messages, threads or "-", result["wall_seconds"], result["mb_per_s"],
+                            "%.1f" % (result["peak_rss_bytes"] / (1024 * 1024)) if result["peak_rss_bytes"] else "?"),
+                            file=sys.stderr)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {"commit": get_commit(),
+              "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "cpu_count": os.cpu_count(),
+              "seed": args.seed,
+              "generator_args": GENERATOR_ARGS + args.generator_args,
+              "results": results}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+    print("Results written to %s" % args.output, file=sys.stderr)
+
+    if args.compare:
+        if compare(results, args.compare, args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
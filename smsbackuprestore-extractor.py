@@ -14,11 +14,11 @@
 # For each contact, it will create a sub-folder within the output folder
 # containing all received images and videos.
 #
-# The script saves the hashes of the created files in a file named 'saved_hashes.pkl'
+# The script saves the hashes of the created files in a file named 'saved_hashes.db'
 # in the output directory, to avoid duplicates across multiple runs. It only prevents
 # duplicates within the same folder, not cross-folder.
 #
-# If you want to reset the saved hashes, delete 'saved_hashes.pkl'.
+# If you want to reset the saved hashes, delete 'saved_hashes.db'.
 # 
 # Links :
 #   https://play.google.com/store/apps/details?id=com.riteshsahu.SMSBackupRestore
@@ -51,18 +51,39 @@ except ModuleNotFoundError:
     print("You can install it by running 'pip install prettytable' in your command line.")
     sys.exit(1)
 
+# Streaming parser, in smsbackuprestore.py next to this script
+from smsbackuprestore import MmsFilter, MmsRecord, CountingReader, get_media_filename
+from smsbackuprestore import iter_mms as iter_mms_records
+
 # Remaining Standard Library Imports
 import argparse
 import base64
 import datetime
 import errno 
 import hashlib
+import html
+import io
+import json
 import logging
+import mmap
+import multiprocessing
 import pickle
+import posixpath
+import queue
+import re
+import sqlite3
+import struct
+import tarfile
+import tempfile
 import time
 import threading
 import traceback
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from functools import partial
+from urllib.request import pathname2url
 from pathlib import Path
 
 # Logging Configuration
@@ -71,6 +92,110 @@ log_filename = "xml-extract.log"
 # Define the is_windows flag
 is_windows = sys.platform == 'win32'
 
+# Content-addressed blob directory inside the output folder. Also used as the
+# hash store namespace recording which blobs have been written.
+BLOB_FOLDER = ".blobs"
+
+# Sidecar of the pickle hash store mapping base64 payload fingerprints to SHA256 values
+PAYLOAD_INDEX_SUFFIX = ".payloads.pkl"
+
+# Per-input-file progress checkpoints inside the output folder
+CHECKPOINT_FOLDER = ".checkpoints"
+CHECKPOINT_INTERVAL = 30  # seconds
+FINGERPRINT_BLOCK_SIZE = 1024 * 1024
+
+# Record of processed input files inside the output folder
+MANIFEST_FILE = "manifest.json"
+
+# With --fsync batch, written files are synced once this many have accumulated
+FSYNC_BATCH_SIZE = 256
+
+# --output-format tar/zip: name of the archive with --archive-layout single, and the
+# number of per-contact archives holding a file descriptor at once
+ARCHIVE_NAME = "media"
+MAX_OPEN_ARCHIVES = 64
+
+# Local file header of a zip member, used to salvage an archive that was never closed
+ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+ZIP_LOCAL_SIGNATURE = b'PK\x03\x04'
+
+# --metrics-file sampling: one sample a second, keeping the most recent hour
+METRICS_SAMPLE_INTERVAL = 1.0
+METRICS_MAX_SAMPLES = 3600
+METRICS_PREFIX = "sms_extractor_"
+
+# --progress: window over which records/s, MB/s and the ETA are measured
+PROGRESS_RATE_WINDOW = 10  # seconds
+
+# --threads auto: seconds between adjustments, the records in flight per worker, and
+# the throughput gain needed to keep adding workers
+AUTOTUNE_INTERVAL = 3
+AUTOTUNE_QUEUE_FACTOR = 4
+AUTOTUNE_MIN_GAIN = 1.05
+
+# Process umask, applied to files created with tempfile.mkstemp (which uses mode 0600)
+FILE_UMASK = os.umask(0)
+os.umask(FILE_UMASK)
+
+# Linux ioctl for copy-on-write clones (reflinks) on Btrfs, XFS and similar
+FICLONE = 0x40049409
+
+class ShardedCounter:
+    # Counter updated without a lock: each thread adds to a cell of its own and
+    # readers sum the cells. A read can miss an increment that is still in
+    # progress, which is fine for progress display.
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.cells = []
+
+    def add(self, n=1):
+        try:
+            cell = self.local.cell
+        except AttributeError:
+            # First increment from this thread
+            cell = self.local.cell = [0]
+            with self.lock:
+                self.cells.append(cell)
+        cell[0] += n
+
+    def value(self):
+        with self.lock:
+            cells = list(self.cells)
+        return sum(cell[0] for cell in cells)
+
+class StageTimes:
+    # Cumulative seconds and bytes per pipeline stage, added without a lock like
+    # ShardedCounter: each thread adds to a dict of its own, merged by snapshot().
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.cells = []
+
+    def add(self, stage, seconds, num_bytes=0):
+        try:
+            cell = self.local.cell
+        except AttributeError:
+            cell = self.local.cell = {}
+            with self.lock:
+                self.cells.append(cell)
+        totals = cell.get(stage)
+        if totals is None:
+            cell[stage] = [seconds, num_bytes]
+        else:
+            totals[0] += seconds
+            totals[1] += num_bytes
+
+    def snapshot(self):
+        with self.lock:
+            cells = list(self.cells)
+        merged = {}
+        for cell in cells:
+            for stage, (seconds, num_bytes) in dict(cell).items():
+                total_seconds, total_bytes = merged.get(stage, (0.0, 0))
+                merged[stage] = (total_seconds + seconds, total_bytes + num_bytes)
+        return merged
+
 # Define the GlobalStats class
 class GlobalStats:
     def __init__(self):
@@ -79,6 +204,16 @@ class GlobalStats:
         self.total_files_created = 0
         self.total_duplicate_images_skipped = 0
         self.total_errors = 0
+        # Cumulative seconds and bytes per pipeline stage, for --metrics-file. Added on
+        # every media item, so these don't take the lock either.
+        self.stage_times = StageTimes()
+        # Input read so far, for --progress. Updated by the parser threads on every
+        # read, so these don't take the lock.
+        self.bytes_parsed = ShardedCounter()
+        self.bytes_skipped = ShardedCounter()
+        self.records_parsed = ShardedCounter()
+        # Largest peak resident memory reported by a worker process, for --metrics-file
+        self.peak_worker_rss = None
 
     def increment_folders_created(self):
         with self.lock:
@@ -96,6 +231,109 @@ class GlobalStats:
         with self.lock:
             self.total_errors += 1
 
+    def snapshot(self):
+        with self.lock:
+            return {"folders_created": self.total_folders_created,
+                    "files_created": self.total_files_created,
+                    "duplicates_skipped": self.total_duplicate_images_skipped,
+                    "errors": self.total_errors}
+
+    def add_stage_time(self, stage, seconds, num_bytes=0):
+        self.stage_times.add(stage, seconds, num_bytes)
+
+    def add_worker_rss(self, rss):
+        if rss is None:
+            return
+        with self.lock:
+            self.peak_worker_rss = max(self.peak_worker_rss or 0, rss)
+
+    def stage_snapshot(self):
+        # {stage: (seconds, bytes)}, plain values that can be returned from a worker process
+        return self.stage_times.snapshot()
+
+# Define the RunConfig class, holding the options that apply to the whole run
+class RunConfig:
+    def __init__(self, output_folder, num_threads=1, executor_type='thread', max_in_flight=4, parse_shards=1,
+                 hash_store_type='sqlite', saved_hashes_file=None, max_depth=1, huge_tree=False,
+                 write_hash_on='media', content_store=False, resume=False, checkpoint_interval=CHECKPOINT_INTERVAL,
+                 force=False, parallel_files=1, payload_index=False, mms_filter=None, inventory=None,
+                 io_threads=4, fsync='none', output_format='files', archive_layout='contact',
+                 metrics_file=None, metrics_format='json', metrics_interval=0,
+                 progress=False, progress_interval=1.0, autotune=False, memory_budget=None):
+        self.output_folder = output_folder
+        self.num_threads = num_threads
+        self.executor_type = executor_type
+        self.max_in_flight = max_in_flight
+        self.parse_shards = parse_shards
+        self.hash_store_type = hash_store_type
+        self.saved_hashes_file = saved_hashes_file
+        self.max_depth = max_depth
+        self.huge_tree = huge_tree
+        # Checkpoints commit the saved hashes only if they are meant to be kept up to date
+        # while a file is processed; with xml or run they wait as documented
+        self.commit_at_checkpoint = write_hash_on in ('media', 'mms')
+        if output_format != 'files' and write_hash_on in ('media', 'mms'):
+            # Archive members are only safely on disk once the archive is closed, at each
+            # checkpoint and at the end of each XML file
+            write_hash_on = 'xml'
+        self.write_hash_on = write_hash_on
+        self.resume = resume
+        self.checkpoint_interval = checkpoint_interval
+        self.force = force
+        self.parallel_files = parallel_files
+        self.payload_index = payload_index
+        self.mms_filter = mms_filter
+        # None for a normal run, or 'table'/'json' to only report what would be extracted
+        self.inventory = inventory
+        self.io_threads = io_threads
+        self.fsync = fsync
+        self.output_format = output_format
+        self.archive_layout = archive_layout
+        self.metrics_file = metrics_file
+        self.metrics_format = metrics_format
+        self.metrics_interval = metrics_interval
+        self.progress = progress
+        self.progress_interval = progress_interval
+        # --threads auto: num_threads and max_in_flight are upper bounds, and the
+        # number of records handed to workers and held in memory is tuned during the run
+        self.autotune = autotune
+        self.memory_budget = memory_budget
+        # Content-addressed mode: one copy per hash in blob_folder, linked into contact folders
+        self.blob_folder = os.path.join(output_folder, BLOB_FOLDER) if content_store else None
+
+# Define the FileStats class, counting one input file while also updating the run totals
+class FileStats(GlobalStats):
+    def __init__(self, global_stats):
+        super().__init__()
+        self.global_stats = global_stats
+        # Progress is only kept for the whole run
+        self.bytes_parsed = global_stats.bytes_parsed
+        self.bytes_skipped = global_stats.bytes_skipped
+        self.records_parsed = global_stats.records_parsed
+
+    def increment_folders_created(self):
+        super().increment_folders_created()
+        self.global_stats.increment_folders_created()
+
+    def increment_files_created(self):
+        super().increment_files_created()
+        self.global_stats.increment_files_created()
+
+    def increment_duplicate_images_skipped(self):
+        super().increment_duplicate_images_skipped()
+        self.global_stats.increment_duplicate_images_skipped()
+
+    def increment_errors(self):
+        super().increment_errors()
+        self.global_stats.increment_errors()
+
+    def add_stage_time(self, stage, seconds, num_bytes=0):
+        # Only kept for the whole run
+        self.global_stats.add_stage_time(stage, seconds, num_bytes)
+
+    def add_worker_rss(self, rss):
+        self.global_stats.add_worker_rss(rss)
+
 def initialize_logging(log_to_console):
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
@@ -126,122 +364,918 @@ def initialize_logging(log_to_console):
         logger.addHandler(consoleHandler)
 
 
-def process_mms(mms, output_folder, saved_hashes, saved_hashes_file, write_hash_on, global_stats, lock):
-    media_list = get_media_list(mms)
-    folder = get_folder_name(mms)
-    with lock:
-        folder_hashes = saved_hashes.get(folder, set())
-    output = get_output_folder(output_folder, folder, global_stats)
+def process_mms(record, config, hash_store, writer, global_stats):
+    # Returns the futures of the writes queued on the output writer.
+    start = time.perf_counter()
+    folder = record.folder
+    output = writer.get_folder(config.output_folder, folder, global_stats)
+    writes = []
+
+    for media in record.media:
+        fingerprint = None
+        if config.payload_index:
+            fingerprint = get_payload_fingerprint(media.data, global_stats)
+            if handle_known_payload(fingerprint, media, output, config, hash_store, writer, global_stats):
+                continue
 
-    for media in media_list:
-        rawdata, sha256, filename = get_file_data(media)
+        rawdata, sha256, filename = get_file_data(media, global_stats)
+        if fingerprint is not None:
+            hash_store.add_payload(fingerprint, sha256)
 
-        if sha256 in folder_hashes:
+        if not hash_store.add(folder, sha256):
             logging.info("Duplicate file skipped: %s", filename)
             global_stats.increment_duplicate_images_skipped()
             continue
 
         outfile = os.path.join(output, filename)
-        timestamp = datetime.datetime.fromtimestamp(float(mms.get("date")) / 1000.0)
-
-        write_file(outfile, rawdata, timestamp, is_windows, global_stats)
-        with lock:
-           folder_hashes.add(sha256)
-        
-        if write_hash_on == 'media':
-            with lock:
-                update_saved_hashes(saved_hashes, folder, folder_hashes, saved_hashes_file, global_stats)
-    
-    if write_hash_on == 'mms':
-        with lock:
-            update_saved_hashes(saved_hashes, folder, folder_hashes, saved_hashes_file, global_stats)
-        
-    mms.clear()
-
-
-def get_media_list(mms):
-    return mms.xpath(".//part[starts-with(@ct, 'image') or starts-with(@ct, 'video')]")
-
-def get_folder_name(mms):
-    address = mms.get("address")
-    contact = mms.get("contact_name")
-    if contact == "(Unknown)":
-        folder = address if address is not None else "Unknown"
-    else:
-        folder = contact
-    return folder
+        timestamp = media.timestamp
+
+        if config.blob_folder is None:
+            # Saved by finish_mms_writes once the file is on disk
+            writes.append((sha256, writer.write(outfile, rawdata, timestamp, global_stats, sha256)))
+            continue
+        store_blob(config.blob_folder, folder, sha256, rawdata, timestamp, outfile, hash_store, writer, global_stats)
+
+        if config.write_hash_on == 'media':
+            hash_store.commit()
+
+    global_stats.add_stage_time('worker', time.perf_counter() - start)
+    return folder, writes
+
+def finish_mms_writes(config, hash_store, result):
+    # Runs in the parser thread when the MMS is collected. Each hash is only saved once
+    # its file is on disk, so a commit here or at a checkpoint never includes the hashes
+    # of files still queued on the writer, for this record or any other.
+    folder, writes = result
+    for sha256, future in writes:
+        if future.result():
+            hash_store.confirm(folder, sha256)
+            if config.write_hash_on == 'media':
+                hash_store.commit()
+        else:
+            hash_store.discard(folder, sha256)
+    if config.write_hash_on == 'mms':
+        hash_store.commit()
+
+
+def get_payload_fingerprint(data, global_stats=None):
+    # Cheap identity of the still-encoded base64 text: its length plus a BLAKE2b
+    # digest. Much cheaper than decoding and hashing with SHA256.
+    start = time.perf_counter()
+    encoded = data.encode('ascii')
+    fingerprint = len(encoded).to_bytes(8, 'big') + hashlib.blake2b(encoded, digest_size=16).digest()
+    if global_stats is not None:
+        global_stats.add_stage_time('fingerprint', time.perf_counter() - start, len(encoded))
+    return fingerprint
+
+def handle_known_payload(fingerprint, media, output, config, hash_store, writer, global_stats):
+    # Returns True if the payload was dealt with using the payload index alone, without
+    # decoding it: a duplicate for this folder, or (with --content-store) an existing
+    # blob that only needs linking.
+    sha256 = hash_store.lookup_payload(fingerprint)
+    if sha256 is None:
+        return False
+    folder = media.folder
+    filename = get_media_filename(media.name, media.content_type, media.part_date, sha256)
+    if hash_store.contains(folder, sha256):
+        logging.info("Duplicate file skipped: %s", filename)
+        global_stats.increment_duplicate_images_skipped()
+        return True
+    if config.blob_folder is None or not hash_store.contains(BLOB_FOLDER, sha256):
+        return False
+    blob_file = get_blob_file(config.blob_folder, sha256)
+    if not os.path.exists(blob_file):
+        return False
+    if not hash_store.add(folder, sha256):
+        logging.info("Duplicate file skipped: %s", filename)
+        global_stats.increment_duplicate_images_skipped()
+        return True
+    outfile = os.path.join(output, filename)
+    try:
+        link_blob(blob_file, outfile)
+        writer.written(outfile)
+        hash_store.confirm(folder, sha256)
+        global_stats.increment_files_created()
+        logging.info("File created: %s", outfile)
+    except OSError as e:
+        hash_store.discard(folder, sha256)
+        logging.error(describe_write_error(e))
+        global_stats.increment_errors()
+    if config.write_hash_on == 'media':
+        hash_store.commit()
+    return True
+
+def decode_media_payloads(payloads, output, mms_date, fsync=False):
+    # Runs in a worker process: decode, hash and write each payload to a temporary
+    # file in the output directory. The parent decides whether to keep it. Also
+    # returns the time spent in each stage and the worker's peak memory, as the
+    # parent's stats aren't shared.
+    start = time.perf_counter()
+    stats = GlobalStats()
+    timestamp = datetime.datetime.fromtimestamp(float(mms_date) / 1000.0)
+    results = []
+    for media in payloads:
+        rawdata, sha256 = decode_media_data(media.data, stats)
+        filename = get_media_filename(media.name, media.content_type, media.part_date, sha256)
+        write_start = time.perf_counter()
+        try:
+            fd, tmpfile = tempfile.mkstemp(prefix='.' + sha256[:16], suffix='.tmp', dir=output)
+            error = None
+            with os.fdopen(fd, 'wb') as f:
+                set_file_mode(f.fileno())
+                f.write(rawdata)
+                f.flush()
+                try:
+                    set_file_time(tmpfile, timestamp, f.fileno())
+                except Exception as e:
+                    error = "Unable to set the file time for %s: %s" % (filename, e)
+                if fsync:
+                    os.fsync(f.fileno())
+        except IOError as e:
+            results.append((sha256, filename, None, len(rawdata), describe_write_error(e)))
+            continue
+        stats.add_stage_time('write', time.perf_counter() - write_start, len(rawdata))
+        results.append((sha256, filename, tmpfile, len(rawdata), error))
+    stats.add_stage_time('worker', time.perf_counter() - start)
+    return results, stats.stage_snapshot(), get_peak_rss_bytes()
+
+def commit_media_results(folder, output, fingerprints, config, hash_store, writer, global_stats, worker_result):
+    # Runs in the parent: dedup bookkeeping for files written by decode_media_payloads.
+    results, stage_times, worker_rss = worker_result
+    for stage, (seconds, num_bytes) in stage_times.items():
+        global_stats.add_stage_time(stage, seconds, num_bytes)
+    global_stats.add_worker_rss(worker_rss)
+    for fingerprint, (sha256, filename, tmpfile, size, error) in zip(fingerprints, results):
+        if fingerprint is not None:
+            hash_store.add_payload(fingerprint, sha256)
+        if error is not None:
+            logging.error(error)
+            global_stats.increment_errors()
+        if tmpfile is None:
+            continue
+
+        if not hash_store.add(folder, sha256):
+            os.remove(tmpfile)
+            logging.info("Duplicate file skipped: %s", filename)
+            global_stats.increment_duplicate_images_skipped()
+            continue
+
+        outfile = os.path.join(output, filename)
+        try:
+            if config.blob_folder is None:
+                writer.place(tmpfile, outfile, global_stats, sha256)
+            else:
+                blob_file = get_blob_file(config.blob_folder, sha256)
+                if hash_store.add(BLOB_FOLDER, sha256) or not os.path.exists(blob_file):
+                    writer.makedirs(os.path.dirname(blob_file))
+                    os.replace(tmpfile, blob_file)
+                    writer.written(blob_file)
+                    hash_store.confirm(BLOB_FOLDER, sha256)
+                else:
+                    os.remove(tmpfile)
+                link_blob(blob_file, outfile)
+                writer.written(outfile)
+            hash_store.confirm(folder, sha256)
+            global_stats.increment_files_created()
+            logging.info("File created: %s", outfile)
+        except OSError as e:
+            hash_store.discard(folder, sha256)
+            logging.error(describe_write_error(e))
+            global_stats.increment_errors()
+
+        if config.write_hash_on == 'media':
+            hash_store.commit()
+
+    if config.write_hash_on == 'mms':
+        hash_store.commit()
+
 
 def get_output_folder(output_folder, folder, global_stats):
     output = os.path.join(output_folder, folder)
     if not os.path.exists(output):
-        os.makedirs(output)
+        try:
+            os.makedirs(output)
+        except FileExistsError:
+            # Created by another file being processed at the same time
+            return output
         logging.info("New folder created: %s", folder)
         global_stats.increment_folders_created()
     return output
 
-def get_file_data(media):
-    rawdata = base64.b64decode(media.get("data"))
+def get_file_data(media, global_stats=None):
+    rawdata, sha256 = decode_media_data(media.data, global_stats)
+    filename = get_media_filename(media.name, media.content_type, media.part_date, sha256)
+    return rawdata, sha256, filename
+
+def decode_media_data(data, global_stats=None):
+    start = time.perf_counter()
+    rawdata = base64.b64decode(data)
+    decoded = time.perf_counter()
     sha256 = hashlib.sha256(rawdata).hexdigest()
-    filename = media.get("cl")
-    if filename == "null":
-        name = media.get("ct")
-        ext = name.split('/')[1]
-        if ext == "jpeg":
-            ext = "jpg"
-        elif name == "image/*":
-            logging.info("Unknown image type * for MMS content; guessing .jpg %s", output)
-            ext = "jpg"
-        elif name == "video/*":
-            logging.info("Unknown video type * for MMS content; guessing .3gpp %s", output)
-            ext = "3gpp"
-        date = media.get("date")
-        if date is None:
-            # handle the case where date is None, e.g., set a default date or skip this item
-            timestamp = datetime.datetime.now()
-        else:
-            timestamp = datetime.datetime.fromtimestamp(float(date) / 1000.0)
+    if global_stats is not None:
+        global_stats.add_stage_time('decode', decoded - start, len(rawdata))
+        global_stats.add_stage_time('hash', time.perf_counter() - decoded, len(rawdata))
+    return rawdata, sha256
 
-        filename = timestamp.strftime("%Y%m%d_%H%M%S%f") + '_' + sha256[:5] + '.' + ext
-    return rawdata, sha256, filename
+def describe_write_error(e):
+    if e.errno == errno.ENOSPC:  # if the error is "No space left on device"
+        return "No space left on the output device."
+    elif e.errno == errno.EACCES:  # if the error is "Permission denied"
+        return "You don't have permission to create this file."
+    else:
+        return "Unknown error occurred while writing the file: %s" % str(e)
 
+def get_filetime(timestamp):
+    return (timestamp - datetime.datetime(1970, 1, 1)).total_seconds()
 
-def write_file(outfile, rawdata, timestamp, is_windows, global_stats):
+def set_file_time(outfile, timestamp, fd=None):
+    # With an open file descriptor the time is set without looking the path up again.
+    filetime = get_filetime(timestamp)
+    if is_windows:
+        setctime(outfile, filetime)
+    else:
+        filetime_ns = int(filetime * 1e9)
+        os.utime(fd if fd is not None and os.utime in os.supports_fd else outfile, ns=(int(filetime_ns), int(filetime_ns)))
+
+def set_file_mode(fd):
+    # Give a file from tempfile.mkstemp the permissions open() would have used
+    if not is_windows:
+        os.fchmod(fd, 0o666 & ~FILE_UMASK)
+
+def fsync_path(path):
+    # Directories can't be opened for syncing on Windows, where a rename is durable
+    # once the file itself is.
+    if os.path.isdir(path):
+        if is_windows:
+            return
+        fd = os.open(path, os.O_RDONLY)
+    else:
+        fd = os.open(path, os.O_RDWR if is_windows else os.O_RDONLY)
     try:
-        with open(outfile, 'wb') as f:
-            f.write(rawdata)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class OutputWriter:
+    # Output stage shared by the whole run. Media files are written by a separate pool
+    # of I/O threads, so decoding carries on while earlier files are written, and
+    # folders that already exist are remembered instead of checked for every MMS.
+    # fsync is 'none', 'file' (each file and its folder, before it counts as written)
+    # or 'batch' (every FSYNC_BATCH_SIZE files, and at each flush).
+    def __init__(self, io_threads, fsync, global_stats):
+        self.executor = ThreadPoolExecutor(max_workers=io_threads)
+        self.fsync = fsync
+        self.global_stats = global_stats
+        self.lock = threading.Lock()
+        self.folders = set()
+        self.pending = set()
+        self.unsynced = []
+
+    def get_folder(self, output_folder, folder, global_stats):
+        output = os.path.join(output_folder, folder)
+        with self.lock:
+            if output in self.folders:
+                return output
+        get_output_folder(output_folder, folder, global_stats)
+        with self.lock:
+            self.folders.add(output)
+        return output
+
+    def makedirs(self, path):
+        with self.lock:
+            if path in self.folders:
+                return
+        os.makedirs(path, exist_ok=True)
+        with self.lock:
+            self.folders.add(path)
+
+    def write(self, outfile, rawdata, timestamp, global_stats, sha256=None):
+        # Queues the file on the I/O threads and returns its future, whose result is
+        # True once the file is written and False if it couldn't be. sha256 is the hash
+        # of rawdata, which archives use to recognise files they already hold.
+        future = self.executor.submit(self.write_logged, outfile, rawdata, timestamp, global_stats, sha256)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.write_done)
+        return future
+
+    def write_done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def write_logged(self, outfile, rawdata, timestamp, global_stats, sha256=None):
+        try:
+            self.write_atomic(outfile, rawdata, timestamp, global_stats)
+        except OSError as e:
+            logging.error(describe_write_error(e))
+            global_stats.increment_errors()
+            return False
         global_stats.increment_files_created()
         logging.info("File created: %s", outfile)
-    except IOError as e:
-        if e.errno == errno.ENOSPC:  # if the error is "No space left on device"
-            logging.error("No space left on the output device.")
-        elif e.errno == errno.EACCES:  # if the error is "Permission denied"
-            logging.error("You don't have permission to create this file.")
+        return True
+
+    def write_atomic(self, outfile, rawdata, timestamp, global_stats):
+        # Written under a temporary name in the same folder and renamed, so outfile
+        # never holds a partial file. Raises OSError if the file can't be written.
+        start = time.perf_counter()
+        fd, tmpfile = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(outfile))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                set_file_mode(f.fileno())
+                f.write(rawdata)
+                f.flush()
+                try:
+                    set_file_time(tmpfile, timestamp, f.fileno())
+                except Exception as e:
+                    logging.error("Unable to set the file time for %s: %s", outfile, e)
+                    global_stats.increment_errors()
+                if self.fsync == 'file':
+                    os.fsync(f.fileno())
+            os.replace(tmpfile, outfile)
+        except BaseException:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
+        self.written(outfile)
+        global_stats.add_stage_time('write', time.perf_counter() - start, len(rawdata))
+
+    def place(self, tmpfile, outfile, global_stats, sha256=None):
+        # Moves a finished temporary file (from a worker process) into place.
+        os.replace(tmpfile, outfile)
+        self.written(outfile)
+
+    def written(self, path):
+        # Called once a file is in its final place, including files renamed or linked
+        # there by the caller.
+        if self.fsync == 'file':
+            fsync_path(os.path.dirname(path))
+        elif self.fsync == 'batch':
+            with self.lock:
+                self.unsynced.append(path)
+                if len(self.unsynced) < FSYNC_BATCH_SIZE:
+                    return
+                batch, self.unsynced = self.unsynced, []
+            self.sync_batch(batch)
+
+    def sync_batch(self, paths):
+        try:
+            for path in paths:
+                fsync_path(path)
+            for folder in set(os.path.dirname(path) for path in paths):
+                fsync_path(folder)
+        except OSError as e:
+            logging.error("Unable to sync written files: %s", e)
+            self.global_stats.increment_errors()
+
+    def flush(self):
+        # Waits for the queued writes and, with fsync 'batch', syncs everything written so far.
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+        if self.fsync == 'batch':
+            with self.lock:
+                batch, self.unsynced = self.unsynced, []
+            if batch:
+                self.sync_batch(batch)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.flush()
+
+class ReopenableFile:
+    # File object for an archive that stays open in memory but only holds a descriptor
+    # while it is in use. release() closes the descriptor; the next call reopens the
+    # file at the same position.
+    def __init__(self, path):
+        self.path = path
+        self.position = 0
+        self.f = None
+
+    def file(self):
+        if self.f is None:
+            self.f = open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b')
+            self.f.seek(self.position)
+        return self.f
+
+    def release(self):
+        if self.f is not None:
+            self.position = self.f.tell()
+            self.f.close()
+            self.f = None
+
+    def read(self, size=-1):
+        return self.file().read(size)
+
+    def write(self, data):
+        return self.file().write(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.file().seek(offset, whence)
+
+    def tell(self):
+        return self.file().tell()
+
+    def truncate(self, size=None):
+        return self.file().truncate(size)
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self.release()
+
+class ArchiveWriter(OutputWriter):
+    # --output-format tar/zip: media is appended to uncompressed archives, one per
+    # contact folder or a single one with a directory per contact, instead of being
+    # written as separate files. A single I/O thread owns the archives, so each one
+    # is written sequentially. Archives are closed (completing them on disk) at every
+    # flush, i.e. at checkpoints and at the end of each XML file. In between they stay
+    # open, and only MAX_OPEN_ARCHIVES of them hold a file descriptor at once.
+    def __init__(self, output_folder, output_format, archive_layout, fsync, global_stats):
+        super().__init__(1, fsync, global_stats)
+        self.output_folder = output_folder
+        self.output_format = output_format
+        self.archive_layout = archive_layout
+        # Archives written to since the last flush, and their file objects, of which
+        # the most recently used MAX_OPEN_ARCHIVES are kept in open_files
+        self.archives = {}
+        self.files = {}
+        self.open_files = {}
+        # Members of each archive used in this run, kept across flushes: name -> SHA256
+        # of the content, or the TarInfo/ZipInfo of a member added by an earlier run
+        self.members = {}
+        # Where the next tar member goes, so a tar is reopened without reading it again
+        self.tar_ends = {}
+
+    def get_folder(self, output_folder, folder, global_stats):
+        # Contact folders only exist inside the archives
+        return os.path.join(output_folder, folder)
+
+    def get_member(self, outfile):
+        # Maps an output path to (archive file, member name)
+        folder, filename = os.path.split(os.path.relpath(outfile, self.output_folder))
+        folder = folder.replace(os.sep, '/')
+        if self.archive_layout == 'single':
+            return os.path.join(self.output_folder, ARCHIVE_NAME + '.' + self.output_format), folder + '/' + filename
+        return os.path.join(self.output_folder, folder + '.' + self.output_format), filename
+
+    def open_archive(self, archive_file, global_stats):
+        archive = self.archives.get(archive_file)
+        if archive is None:
+            if not os.path.exists(archive_file):
+                logging.info("New archive created: %s", archive_file)
+                global_stats.increment_folders_created()
+            if archive_file not in self.members:
+                # First use in this run: index the members added by earlier runs
+                try:
+                    self.read_members(archive_file)
+                except (tarfile.ReadError, zipfile.BadZipFile) as e:
+                    logging.warning("Repairing archive left incomplete by an interrupted run: %s (%s)", archive_file, e)
+                    if self.output_format == 'tar':
+                        recover_tar(archive_file)
+                    else:
+                        recover_zip(archive_file)
+                    self.read_members(archive_file)
+            archive = self.open_archive_file(archive_file)
+            self.archives[archive_file] = archive
+        # Most recently used last, so the first entry is the one to release when too many are open
+        self.open_files.pop(archive_file, None)
+        self.open_files[archive_file] = self.files[archive_file]
+        while len(self.open_files) > MAX_OPEN_ARCHIVES:
+            self.open_files.pop(next(iter(self.open_files))).release()
+        return archive
+
+    def read_members(self, archive_file):
+        # Raises tarfile.ReadError or zipfile.BadZipFile if the archive needs repairing
+        members = {}
+        end = 0
+        if os.path.exists(archive_file) and os.path.getsize(archive_file):
+            if self.output_format == 'tar':
+                size = os.path.getsize(archive_file)
+                with tarfile.open(archive_file, 'r') as tar:
+                    for member in tar:
+                        end = member.offset_data + (member.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+                        if end > size:
+                            raise tarfile.ReadError("truncated member %s" % member.name)
+                        members[member.name] = member
+            else:
+                if not zipfile.is_zipfile(archive_file):
+                    # ZipFile would start a new archive after the unreadable data instead
+                    raise zipfile.BadZipFile("no central directory")
+                with zipfile.ZipFile(archive_file) as archive:
+                    members = {info.filename: info for info in archive.infolist()}
+        self.members[archive_file] = members
+        self.tar_ends[archive_file] = end
+
+    def open_archive_file(self, archive_file):
+        fileobj = ReopenableFile(archive_file)
+        self.files[archive_file] = fileobj
+        if self.output_format == 'tar':
+            # Overwrites the end-of-archive blocks; close() writes them again
+            fileobj.seek(self.tar_ends[archive_file])
+            fileobj.truncate()
+            return tarfile.open(fileobj=fileobj, mode='w', format=tarfile.PAX_FORMAT)
+        return zipfile.ZipFile(fileobj, 'a', compression=zipfile.ZIP_STORED, allowZip64=True, strict_timestamps=False)
+
+    def close_archive(self, archive_file):
+        archive = self.archives.pop(archive_file)
+        fileobj = self.files.pop(archive_file)
+        self.open_files.pop(archive_file, None)
+        if self.output_format == 'tar':
+            self.tar_ends[archive_file] = fileobj.tell()
+        archive.close()
+        fileobj.close()
+        if self.fsync != 'none':
+            fsync_path(archive_file)
+
+    def close_archives(self):
+        try:
+            while self.archives:
+                self.close_archive(next(iter(self.archives)))
+            if self.fsync != 'none':
+                fsync_path(self.output_folder)
+        except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+            logging.error("Unable to close archive: %s", e)
+            self.global_stats.increment_errors()
+
+    def get_member_sha256(self, archive_file, name):
+        # Members from earlier runs are only read and hashed when a new file has their name
+        sha256 = self.members[archive_file][name]
+        if isinstance(sha256, str):
+            return sha256
+        if self.output_format == 'tar':
+            fileobj = self.files[archive_file]
+            position = fileobj.tell()
+            fileobj.seek(sha256.offset_data)
+            data = fileobj.read(sha256.size)
+            fileobj.seek(position)
         else:
-            logging.error("Unknown error occurred while writing the file: %s", str(e))
-        global_stats.increment_errors()
-        return
+            data = self.archives[archive_file].read(sha256)
+        sha256 = hashlib.sha256(data).hexdigest()
+        self.members[archive_file][name] = sha256
+        return sha256
 
-    if os.path.exists(outfile):
-        filetime = (timestamp - datetime.datetime(1970, 1, 1)).total_seconds()
+    def choose_member_name(self, archive_file, name, sha256):
+        # Returns the name to add the file under, or None if the same content is already
+        # in the archive under its name. A different file with the same name is added
+        # with the start of its hash appended, as unnamed parts are named.
+        members = self.members[archive_file]
+        stem, ext = posixpath.splitext(name)
+        for candidate in (name, stem + '_' + sha256[:8] + ext, stem + '_' + sha256 + ext):
+            if candidate not in members:
+                return candidate
+            if self.get_member_sha256(archive_file, candidate) == sha256:
+                return None
+        return candidate
+
+    def add_member(self, outfile, global_stats, sha256, rawdata=None, timestamp=None, source=None):
+        # Runs on the I/O thread. Adds either rawdata or the contents of the file source.
+        start = time.perf_counter()
+        archive_file, name = self.get_member(outfile)
         try:
-            if is_windows:
-                setctime(outfile, filetime)
+            archive = self.open_archive(archive_file, global_stats)
+            member_name = self.choose_member_name(archive_file, name, sha256)
+            if member_name is None:
+                # Already added by an earlier run that stopped before saving its hashes
+                logging.info("Already in archive: %s", outfile)
+                return
+            if member_name != name:
+                logging.info("Another file named %s is in %s; adding this one as %s", name, archive_file, member_name)
+            name = member_name
+            self.members[archive_file][name] = sha256
+            size = len(rawdata) if source is None else os.path.getsize(source)
+            if self.output_format == 'tar':
+                if source is not None:
+                    archive.add(source, arcname=name)
+                else:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(rawdata)
+                    info.mtime = get_filetime(timestamp)
+                    info.mode = 0o666 & ~FILE_UMASK
+                    archive.addfile(info, io.BytesIO(rawdata))
+            elif source is not None:
+                archive.write(source, arcname=name)
             else:
-                filetime_ns = int(filetime * 1e9)
-                os.utime(outfile, ns=(int(filetime_ns), int(filetime_ns)))
-        except Exception as e:
-            logging.error("Unable to set the file time for %s: %s", outfile, e)
+                date_time = time.localtime(get_filetime(timestamp))[:6]
+                info = zipfile.ZipInfo(name, date_time=max(date_time, (1980, 1, 1, 0, 0, 0)))
+                info.external_attr = (0o100000 | (0o666 & ~FILE_UMASK)) << 16
+                archive.writestr(info, rawdata)
+            global_stats.add_stage_time('write', time.perf_counter() - start, size)
+        except (tarfile.TarError, zipfile.BadZipFile) as e:
+            raise OSError("Unable to add %s to %s: %s" % (name, archive_file, e))
+
+    def write_logged(self, outfile, rawdata, timestamp, global_stats, sha256=None):
+        try:
+            self.add_member(outfile, global_stats, sha256, rawdata=rawdata, timestamp=timestamp)
+        except OSError as e:
+            logging.error(describe_write_error(e))
             global_stats.increment_errors()
+            return False
+        global_stats.increment_files_created()
+        logging.info("File created: %s", outfile)
+        return True
+
+    def place(self, tmpfile, outfile, global_stats, sha256=None):
+        try:
+            self.executor.submit(self.add_member, outfile, global_stats, sha256, source=tmpfile).result()
+        finally:
+            os.remove(tmpfile)
 
-def update_saved_hashes(saved_hashes, folder, folder_hashes, saved_hashes_file, global_stats):
-    saved_hashes[folder] = folder_hashes
+    def written(self, path):
+        # Archives are synced as a whole when they are closed
+        pass
+
+    def flush(self):
+        # Queued after every write submitted so far, on the same thread
+        self.executor.submit(self.close_archives).result()
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+def recover_tar(archive_file):
+    # Cut the archive back to its last complete member and end it there, so it can be
+    # opened for appending again.
+    size = os.path.getsize(archive_file)
+    end = 0
     try:
-        with open(saved_hashes_file, 'wb') as f:
-            pickle.dump(saved_hashes, f)
-    except IOError as e:
-        logging.error("Unable to write saved hashes file: %s", e)
+        with tarfile.open(archive_file, 'r') as tar:
+            for member in tar:
+                member_end = member.offset_data + (member.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+                if member_end > size:
+                    break
+                end = member_end
+    except tarfile.ReadError:
+        pass
+    with open(archive_file, 'r+b') as f:
+        f.truncate(end)
+        f.seek(end)
+        f.write(b'\0' * (2 * tarfile.BLOCKSIZE))
+
+def recover_zip(archive_file):
+    # A zip can't be read without the central directory written when it is closed.
+    # Copy the complete members found through their local headers into a new archive.
+    tmpfile = archive_file + '.tmp'
+    with open(archive_file, 'rb') as src, zipfile.ZipFile(tmpfile, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as dst:
+        while True:
+            header = src.read(ZIP_LOCAL_HEADER.size)
+            if len(header) < ZIP_LOCAL_HEADER.size:
+                break
+            (signature, _, _, flags, compression, mtime, mdate, crc,
+             compressed_size, file_size, name_length, extra_length) = ZIP_LOCAL_HEADER.unpack(header)
+            if (signature != ZIP_LOCAL_SIGNATURE or compression != zipfile.ZIP_STORED or flags & 0x08
+                    or compressed_size == 0xFFFFFFFF):
+                break
+            name = src.read(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+            src.seek(extra_length, os.SEEK_CUR)
+            data = src.read(compressed_size)
+            if len(data) < compressed_size or zlib.crc32(data) != crc:
+                break
+            info = zipfile.ZipInfo(name, date_time=((mdate >> 9) + 1980, (mdate >> 5) & 0xF, mdate & 0x1F,
+                                                    mtime >> 11, (mtime >> 5) & 0x3F, (mtime & 0x1F) * 2))
+            info.external_attr = (0o100000 | (0o666 & ~FILE_UMASK)) << 16
+            dst.writestr(info, data)
+    os.replace(tmpfile, archive_file)
+
+def get_blob_file(blob_folder, sha256):
+    return os.path.join(blob_folder, sha256[:2], sha256)
+
+def reflink_file(src, dst):
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+def link_blob(blob_file, outfile):
+    # Hardlink the blob into the contact folder. Falls back to a reflink, then a
+    # relative symlink, on filesystems without hardlink support.
+    if os.path.lexists(outfile):
+        os.remove(outfile)
+    try:
+        os.link(blob_file, outfile)
+        return
+    except OSError as e:
+        link_error = e
+    if sys.platform.startswith('linux'):
+        try:
+            reflink_file(blob_file, outfile)
+            return
+        except OSError:
+            if os.path.lexists(outfile):
+                os.remove(outfile)
+    try:
+        os.symlink(os.path.relpath(blob_file, os.path.dirname(outfile)), outfile)
+    except OSError:
+        raise link_error
+
+def store_blob(blob_folder, folder, sha256, rawdata, timestamp, outfile, hash_store, writer, global_stats):
+    # The global blob index decides whether the data needs to be written at all. Blobs
+    # are written directly rather than queued, since the link needs them to exist.
+    blob_file = get_blob_file(blob_folder, sha256)
+    try:
+        writer.makedirs(os.path.dirname(blob_file))
+        if hash_store.add(BLOB_FOLDER, sha256):
+            writer.write_atomic(blob_file, rawdata, timestamp, global_stats)
+            hash_store.confirm(BLOB_FOLDER, sha256)
+        try:
+            link_blob(blob_file, outfile)
+        except FileNotFoundError:
+            # Recorded in the index but missing on disk (deleted, or still being
+            # written by another thread): write it again.
+            writer.write_atomic(blob_file, rawdata, timestamp, global_stats)
+            hash_store.confirm(BLOB_FOLDER, sha256)
+            link_blob(blob_file, outfile)
+        writer.written(outfile)
+        hash_store.confirm(folder, sha256)
+        global_stats.increment_files_created()
+        logging.info("File created: %s", outfile)
+    except OSError as e:
+        hash_store.discard(folder, sha256)
+        logging.error(describe_write_error(e))
         global_stats.increment_errors()
 
+class PickleHashStore:
+    # Original saved_hashes.pkl format: a {folder: set(sha256)} dict, rewritten in full on every commit.
+    # With read_only, commit() doesn't write anything.
+    def __init__(self, saved_hashes_file, global_stats, read_only=False):
+        self.lock = threading.Lock()
+        self.read_only = read_only
+        self.saved_hashes_file = saved_hashes_file
+        self.payload_index_file = os.path.splitext(saved_hashes_file)[0] + PAYLOAD_INDEX_SUFFIX
+        self.global_stats = global_stats
+        self.saved_hashes = load_saved_hashes(saved_hashes_file, global_stats)
+        self.payload_index = load_saved_hashes(self.payload_index_file, global_stats)
+        # (folder, sha256) of files being written, kept out of the saved hashes until confirmed
+        self.pending = set()
+
+    def contains(self, folder, sha256):
+        with self.lock:
+            return sha256 in self.saved_hashes.get(folder, ()) or (folder, sha256) in self.pending
+
+    def add(self, folder, sha256):
+        # Returns False if the hash was already recorded for this folder. A new hash
+        # counts for deduplication straight away but is only saved once confirmed.
+        with self.lock:
+            if sha256 in self.saved_hashes.get(folder, ()) or (folder, sha256) in self.pending:
+                return False
+            self.pending.add((folder, sha256))
+            return True
+
+    def confirm(self, folder, sha256):
+        # The file for this hash is on disk, so the next commit can save it
+        with self.lock:
+            self.pending.discard((folder, sha256))
+            self.saved_hashes.setdefault(folder, set()).add(sha256)
+
+    def discard(self, folder, sha256):
+        # The file for this hash couldn't be written
+        with self.lock:
+            self.pending.discard((folder, sha256))
+
+    def lookup_payload(self, fingerprint):
+        with self.lock:
+            return self.payload_index.get(fingerprint)
+
+    def add_payload(self, fingerprint, sha256):
+        with self.lock:
+            self.payload_index[fingerprint] = sha256
+
+    def commit(self):
+        if self.read_only:
+            return
+        start = time.perf_counter()
+        with self.lock:
+            try:
+                with open(self.saved_hashes_file, 'wb') as f:
+                    pickle.dump(self.saved_hashes, f)
+                with open(self.payload_index_file, 'wb') as f:
+                    pickle.dump(self.payload_index, f)
+            except IOError as e:
+                logging.error("Unable to write saved hashes file: %s", e)
+                self.global_stats.increment_errors()
+        self.global_stats.add_stage_time('hash_commit', time.perf_counter() - start)
+
+    def close(self):
+        self.commit()
+
+class SQLiteHashStore:
+    # Hashes kept in an SQLite database in WAL mode. Each new hash is a single indexed
+    # insert, lookups don't need the whole store in memory, and commit() only flushes
+    # the inserts made since the last commit. New hashes are only inserted once their
+    # file is confirmed to be on disk. With read_only, an existing database is opened
+    # without creating or changing anything.
+    def __init__(self, saved_hashes_file, global_stats, read_only=False):
+        self.lock = threading.Lock()
+        self.global_stats = global_stats
+        self.read_only = read_only
+        # (folder, sha256) of files being written, not inserted until confirmed
+        self.pending = set()
+        if read_only:
+            # mode=ro still creates the -wal and -shm files of a WAL database. Without a
+            # -wal file no other connection has it open, so it can be read as immutable.
+            uri = 'file:%s?mode=ro' % pathname2url(os.path.abspath(saved_hashes_file))
+            if not os.path.exists(saved_hashes_file + '-wal'):
+                uri += '&immutable=1'
+            self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            return
+        self.conn = sqlite3.connect(saved_hashes_file, check_same_thread=False, isolation_level='DEFERRED')
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS saved_hashes (
+                            folder TEXT NOT NULL,
+                            sha256 BLOB NOT NULL,
+                            PRIMARY KEY (folder, sha256)) WITHOUT ROWID''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS payload_index (
+                            fingerprint BLOB PRIMARY KEY,
+                            sha256 BLOB NOT NULL) WITHOUT ROWID''')
+        self.conn.commit()
+
+    # Lookups and inserts are timed as the 'hash_lookup' stage, including any wait for the lock.
+    def contains(self, folder, sha256):
+        start = time.perf_counter()
+        with self.lock:
+            found = self.contains_locked(folder, sha256)
+        self.global_stats.add_stage_time('hash_lookup', time.perf_counter() - start)
+        return found
+
+    def contains_locked(self, folder, sha256):
+        if (folder, sha256) in self.pending:
+            return True
+        return self.conn.execute('SELECT 1 FROM saved_hashes WHERE folder=? AND sha256=?',
+                                 (folder, bytes.fromhex(sha256))).fetchone() is not None
+
+    def add(self, folder, sha256):
+        # Returns False if the hash was already recorded for this folder. A new hash
+        # counts for deduplication straight away but is only inserted once confirmed.
+        start = time.perf_counter()
+        with self.lock:
+            added = not self.contains_locked(folder, sha256)
+            if added:
+                self.pending.add((folder, sha256))
+        self.global_stats.add_stage_time('hash_lookup', time.perf_counter() - start)
+        return added
+
+    def confirm(self, folder, sha256):
+        # The file for this hash is on disk, so the next commit can save it
+        with self.lock:
+            self.pending.discard((folder, sha256))
+            self.conn.execute('INSERT OR IGNORE INTO saved_hashes (folder, sha256) VALUES (?, ?)',
+                              (folder, bytes.fromhex(sha256)))
+
+    def discard(self, folder, sha256):
+        # The file for this hash couldn't be written
+        with self.lock:
+            self.pending.discard((folder, sha256))
+
+    def lookup_payload(self, fingerprint):
+        start = time.perf_counter()
+        with self.lock:
+            row = self.conn.execute('SELECT sha256 FROM payload_index WHERE fingerprint=?', (fingerprint,)).fetchone()
+        self.global_stats.add_stage_time('hash_lookup', time.perf_counter() - start)
+        return row[0].hex() if row is not None else None
+
+    def add_payload(self, fingerprint, sha256):
+        start = time.perf_counter()
+        with self.lock:
+            self.conn.execute('INSERT OR IGNORE INTO payload_index (fingerprint, sha256) VALUES (?, ?)',
+                              (fingerprint, bytes.fromhex(sha256)))
+        self.global_stats.add_stage_time('hash_lookup', time.perf_counter() - start)
+
+    def is_empty(self):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM saved_hashes LIMIT 1').fetchone() is None
+
+    def import_pickle(self, pickle_file):
+        saved_hashes = load_saved_hashes(pickle_file, self.global_stats)
+        with self.lock:
+            for folder, folder_hashes in saved_hashes.items():
+                if folder is None or not folder_hashes:
+                    continue
+                self.conn.executemany('INSERT OR IGNORE INTO saved_hashes (folder, sha256) VALUES (?, ?)',
+                                      ((folder, bytes.fromhex(sha256)) for sha256 in folder_hashes))
+            self.conn.commit()
+        logging.info("Imported saved hashes from %s", pickle_file)
+
+    def commit(self):
+        if self.read_only:
+            return
+        start = time.perf_counter()
+        with self.lock:
+            try:
+                self.conn.commit()
+            except sqlite3.Error as e:
+                logging.error("Unable to write saved hashes database: %s", e)
+                self.global_stats.increment_errors()
+        self.global_stats.add_stage_time('hash_commit', time.perf_counter() - start)
+
+    def close(self):
+        self.commit()
+        with self.lock:
+            self.conn.close()
+
 def load_saved_hashes(saved_hashes_file, global_stats):
     try:
         with open(saved_hashes_file, 'rb') as f:
@@ -254,31 +1288,534 @@ def load_saved_hashes(saved_hashes_file, global_stats):
         sys.exit(1)
     return saved_hashes
 
-def process_xml_file(input_file, output_folder, num_threads, saved_hashes, saved_hashes_file, huge_tree, write_hash_on, global_stats, lock, xml_files_found):
-    xml_files_found[0] = True
-    futures = [] 
+def open_hash_store(hash_store_type, saved_hashes_file, global_stats, read_only=False):
+    # With read_only (for --inventory), saved_hashes_file must exist and is not changed
+    if hash_store_type == 'pickle':
+        return PickleHashStore(saved_hashes_file, global_stats, read_only)
+    try:
+        hash_store = SQLiteHashStore(saved_hashes_file, global_stats, read_only)
+        # Carry over hashes from an existing saved_hashes.pkl the first time the database is used
+        legacy_file = os.path.splitext(saved_hashes_file)[0] + '.pkl'
+        if hash_store.is_empty() and os.path.exists(legacy_file):
+            if read_only:
+                # A normal run would import it, so read the hashes from it instead
+                hash_store.close()
+                return PickleHashStore(legacy_file, global_stats, read_only)
+            hash_store.import_pickle(legacy_file)
+    except sqlite3.Error as e:
+        logging.error("Unable to open saved hashes database: %s", e)
+        global_stats.increment_errors()
+        sys.exit(1)
+    return hash_store
+
+# MMS index sidecar, written next to the input file
+MMS_INDEX_SUFFIX = ".mmsidx"
+MMS_INDEX_VERSION = 3
+
+# Byte patterns used to locate <mms> records without parsing the XML
+MMS_START_RE = re.compile(rb'<mms[\s>/]')
+MMS_START_TAG_RE = re.compile(rb'<mms(?:\s+[^\s=>/]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*(/?)>')
+MMS_ATTR_RE = re.compile(rb'([^\s=>/]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+PART_START_RE = re.compile(rb'<part[\s>/]')
+MMS_END = b'</mms>'
+ROOT_END = b'</smses>'
+
+def get_start_tag_attributes(start_tag):
+    attributes = {}
+    for m in MMS_ATTR_RE.finditer(start_tag):
+        value = m.group(2) if m.group(2) is not None else m.group(3)
+        attributes[m.group(1).decode('utf-8')] = html.unescape(value.decode('utf-8', 'replace'))
+    return attributes
+
+def build_mms_index(input_file):
+    # Scan the raw bytes for <mms> records. Returns (records, complete): records are
+    # (start, end, date, address, contact_name, part_count) tuples, where start/end are
+    # byte offsets of the whole element, and complete is False if part of the file could
+    # not be indexed, e.g. a malformed start tag or a truncated file.
+    records = []
+    complete = True
+    with open(input_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return records, False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0
+            while True:
+                m = MMS_START_RE.search(mm, pos)
+                if m is None:
+                    break
+                start = m.start()
+                tag = MMS_START_TAG_RE.match(mm, start)
+                if tag is None:
+                    logging.error("Malformed <mms> start tag at byte %d in %s", start, input_file)
+                    complete = False
+                    pos = m.end()
+                    continue
+                if tag.group(1):
+                    end = tag.end()
+                else:
+                    end = mm.find(MMS_END, tag.end())
+                    if end == -1:
+                        logging.error("Unterminated <mms> element at byte %d in %s", start, input_file)
+                        complete = False
+                        break
+                    end += len(MMS_END)
+                attributes = get_start_tag_attributes(tag.group(0))
+                part_count = sum(1 for _ in PART_START_RE.finditer(mm, tag.end(), end))
+                records.append((start, end, attributes.get("date"), attributes.get("address"),
+                                attributes.get("contact_name"), part_count))
+                pos = end
+            if complete and not mm[max(pos, len(mm) - 4096):].rstrip().endswith(ROOT_END):
+                logging.error("No closing %s tag at the end of %s", ROOT_END.decode(), input_file)
+                complete = False
+    return records, complete
+
+def load_mms_index(input_file):
+    # Reuse the sidecar index if the input file has not changed since it was built.
+    # Returns (records, complete) as build_mms_index does.
+    index_file = input_file + MMS_INDEX_SUFFIX
+    st = os.stat(input_file)
+    try:
+        with open(index_file, 'rb') as f:
+            index = pickle.load(f)
+        if (index.get("version") == MMS_INDEX_VERSION and index.get("size") == st.st_size
+                and index.get("mtime_ns") == st.st_mtime_ns):
+            logging.info("Using MMS index: %s", index_file)
+            return index["records"], index["complete"]
+    except FileNotFoundError:
+        pass
+    except (IOError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+        logging.info("Ignoring unreadable MMS index %s: %s", index_file, e)
+
+    logging.info("Indexing: %s", input_file)
+    records, complete = build_mms_index(input_file)
+    index = {"version": MMS_INDEX_VERSION, "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+             "records": records, "complete": complete}
+    try:
+        with open(index_file, 'wb') as f:
+            pickle.dump(index, f)
+    except IOError as e:
+        logging.info("Unable to write MMS index %s: %s", index_file, e)
+    return records, complete
+
+def split_shards(records, first_ordinal, num_shards):
+    # One shard per parser thread, dealt out in turn: record first_ordinal + i goes to
+    # shard i % num_shards. Every shard then works on the same stretch of the file, so
+    # records can be yielded in document order while all the threads keep parsing.
+    # Each record is paired with its ordinal (position in the file).
+    num_shards = max(1, min(num_shards, len(records) - first_ordinal))
+    return [[(ordinal, records[ordinal]) for ordinal in range(first_ordinal + i, len(records), num_shards)]
+            for i in range(num_shards)]
+
+def parse_shard(mm, shard, huge_tree, mms_filter, records_queue, stop_event, errors, global_stats):
+    # lxml releases the GIL while parsing, so shards run in parallel threads. Records
+    # that fail to parse are logged and their errors added to errors.
+    parser = etree.XMLParser(huge_tree=huge_tree)
+    try:
+        for ordinal, (start, end, date, address, contact_name, _) in shard:
+            if stop_event.is_set():
+                return
+            if mms_filter is not None and not mms_filter.matches_record(date, address, contact_name):
+                # Decided from the index alone; the record's bytes are never parsed
+                record = None
+            else:
+                try:
+                    record = MmsRecord.from_element(etree.fromstring(mm[start:end], parser), ordinal, mms_filter)
+                except etree.XMLSyntaxError as e:
+                    logging.error("XML syntax error in MMS at byte %d: %s", start, str(e))
+                    errors.append(e)
+                    record = None
+            global_stats.bytes_parsed.add(end - start)
+            while not stop_event.is_set():
+                try:
+                    records_queue.put((ordinal, record), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+    finally:
+        records_queue.put(None)
+
+def iter_indexed_mms(input_file, records, first_ordinal, num_shards, huge_tree, mms_filter, max_in_flight, global_stats):
+    # Parse the indexed byte ranges from first_ordinal onwards with one thread per
+    # shard and yield (ordinal, record) in document order, as --parse-shards 1 does.
+    # record is None for records that failed to parse or were filtered out. Once every
+    # record has been yielded, the first syntax error met by any shard is raised, so the
+    # file is not marked as finished.
+    shards = [shard for shard in split_shards(records, first_ordinal, num_shards) if shard]
+    file_size = os.path.getsize(input_file)
+    # Bytes before the first record to parse count as skipped for --progress
+    first_byte = records[first_ordinal][0] if first_ordinal < len(records) else file_size
+    global_stats.bytes_skipped.add(first_byte)
+    if not shards:
+        global_stats.bytes_parsed.add(file_size - first_byte)
+        return
+    # Each shard has its own queue, so a thread that gets ahead waits for the records
+    # before its next one to be taken rather than filling a shared queue
+    queues = [queue.Queue(maxsize=max(1, max_in_flight // len(shards))) for _ in shards]
+    stop_event = threading.Event()
+    errors = []
+    with open(input_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        threads = [threading.Thread(target=parse_shard, args=(mm, shard, huge_tree, mms_filter, records_queue, stop_event, errors, global_stats), daemon=True)
+                   for shard, records_queue in zip(shards, queues)]
+        for thread in threads:
+            thread.start()
+        try:
+            active = list(queues)
+            while active:
+                # The shards take turns, so the next ordinal is at the head of the next queue
+                for records_queue in list(active):
+                    item = records_queue.get()
+                    if item is None:
+                        active.remove(records_queue)
+                    else:
+                        yield item
+            # The <sms> records and markup between the MMS records
+            record_bytes = sum(end - start for shard in shards for _, (start, end, *_) in shard)
+            global_stats.bytes_parsed.add(file_size - first_byte - record_bytes)
+            if errors:
+                raise errors[0]
+        finally:
+            stop_event.set()
+            while any(thread.is_alive() for thread in threads):
+                for records_queue in queues:
+                    try:
+                        records_queue.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+            for thread in threads:
+                thread.join()
+
+def drain_pending(pending, max_pending, global_stats, tracker, in_flight):
+    # Collect finished MMS records in document order. Blocks on the oldest record
+    # while more than max_pending are outstanding, which throttles the parser.
+    while pending and (len(pending) > max_pending or pending[0][1].done()):
+        ordinal, future, on_result = pending.popleft()
+        try:
+            result = future.result()
+            if on_result is not None:
+                on_result(result)
+        except Exception as e:
+            logging.error("Error processing MMS: %s", e)
+            global_stats.increment_errors()
+        in_flight.release()
+        tracker.mark_done(ordinal)
+
+class InFlightLimiter:
+    # Counts the MMS records held in memory across every file being parsed. Parsers
+    # waiting for a slot are woken whenever a record finishes (notify) or is
+    # released, so they can collect their own finished records without polling.
+    def __init__(self, limit):
+        self.condition = threading.Condition()
+        self.limit = limit
+        self.count = 0
+        self.generation = 0
+        # Records submitted to the executor and not yet finished, for --metrics-file
+        self.tasks = 0
+        # With --threads auto, the number of records handed to workers at once
+        self.worker_limit = None
+
+    def add_task(self, future):
+        with self.condition:
+            self.tasks += 1
+        future.add_done_callback(self.notify)
+
+    def try_acquire(self):
+        with self.condition:
+            if self.count < self.limit and (self.worker_limit is None or self.tasks < self.worker_limit):
+                self.count += 1
+                return True
+            return False
+
+    def resize(self, limit, worker_limit):
+        # Records already in flight above a lowered limit finish normally
+        with self.condition:
+            self.limit = limit
+            self.worker_limit = worker_limit
+            self.generation += 1
+            self.condition.notify_all()
+
+    def release(self):
+        with self.condition:
+            self.count -= 1
+            self.generation += 1
+            self.condition.notify_all()
+
+    def notify(self, future=None):
+        with self.condition:
+            if future is not None:
+                self.tasks -= 1
+            self.generation += 1
+            self.condition.notify_all()
+
+    def wait_for_change(self, generation, timeout=1.0):
+        with self.condition:
+            self.condition.wait_for(lambda: self.generation != generation, timeout)
+
+class CheckpointTracker:
+    # Tracks the number of leading MMS records (by ordinal) that are fully processed.
+    # Records may finish out of order, so later ones wait in 'done' until the gap closes.
+    def __init__(self, completed):
+        self.completed = completed
+        self.done = set()
+
+    def mark_done(self, ordinal):
+        self.done.add(ordinal)
+        while self.completed in self.done:
+            self.done.remove(self.completed)
+            self.completed += 1
+
+def get_file_fingerprint(input_file):
+    # Cheap identity for an input file: its size plus a hash of the first and last MiB.
+    size = os.path.getsize(input_file)
+    sha256 = hashlib.sha256(str(size).encode())
+    with open(input_file, 'rb') as f:
+        sha256.update(f.read(FINGERPRINT_BLOCK_SIZE))
+        if size > FINGERPRINT_BLOCK_SIZE:
+            f.seek(max(FINGERPRINT_BLOCK_SIZE, size - FINGERPRINT_BLOCK_SIZE))
+            sha256.update(f.read(FINGERPRINT_BLOCK_SIZE))
+    return sha256.hexdigest()
+
+class Manifest:
+    # Record of the input files already processed into this output folder, so that
+    # unchanged files can be skipped on later runs.
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.lock = threading.Lock()
+        try:
+            with open(manifest_file, 'r', encoding='utf-8') as f:
+                self.files = json.load(f)
+        except FileNotFoundError:
+            self.files = {}
+        except (IOError, ValueError) as e:
+            logging.error("Unable to read manifest file %s, all files will be processed: %s", manifest_file, e)
+            self.files = {}
+
+    def is_unchanged(self, input_file, selection=None):
+        # A file processed without a filter covers every selection; one processed with
+        # a filter only covers the same filter.
+        with self.lock:
+            entry = self.files.get(os.path.abspath(input_file))
+        if entry is None or entry.get("filter") not in (None, selection):
+            return False
+        st = os.stat(input_file)
+        if entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            return True
+        # Touched or copied but possibly identical: compare contents before reprocessing
+        if entry["size"] == st.st_size and entry["fingerprint"] == get_file_fingerprint(input_file):
+            with self.lock:
+                entry["mtime_ns"] = st.st_mtime_ns
+            return True
+        return False
+
+    def record(self, input_file, fingerprint, stats, selection=None):
+        st = os.stat(input_file)
+        with self.lock:
+            self.files[os.path.abspath(input_file)] = {
+                "size": st.st_size, "mtime_ns": st.st_mtime_ns, "fingerprint": fingerprint, "filter": selection,
+                "processed": datetime.datetime.now().isoformat(timespec='seconds'), "stats": stats}
+
+    def save(self, global_stats):
+        try:
+            with self.lock:
+                tmpfile = self.manifest_file + '.tmp'
+                with open(tmpfile, 'w', encoding='utf-8') as f:
+                    json.dump(self.files, f, indent=1, sort_keys=True)
+                os.replace(tmpfile, self.manifest_file)
+        except IOError as e:
+            logging.error("Unable to write manifest file %s: %s", self.manifest_file, e)
+            global_stats.increment_errors()
+
+def get_checkpoint_file(output_folder, fingerprint):
+    return os.path.join(output_folder, CHECKPOINT_FOLDER, fingerprint[:32] + '.json')
+
+def load_checkpoint(checkpoint_file, fingerprint, selection=None):
+    try:
+        with open(checkpoint_file, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (IOError, ValueError) as e:
+        logging.error("Unable to read checkpoint file %s: %s", checkpoint_file, e)
+        return None
+    if checkpoint.get("fingerprint") != fingerprint or checkpoint.get("filter") != selection:
+        return None
+    return checkpoint
+
+def save_checkpoint(checkpoint_file, input_file, fingerprint, selection, completed, finished, global_stats):
+    checkpoint = {"input_file": os.path.abspath(input_file), "fingerprint": fingerprint, "filter": selection,
+                  "completed": completed, "finished": finished,
+                  "updated": datetime.datetime.now().isoformat(timespec='seconds')}
+    try:
+        os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+        tmpfile = checkpoint_file + '.tmp'
+        with open(tmpfile, 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmpfile, checkpoint_file)
+    except IOError as e:
+        logging.error("Unable to write checkpoint file %s: %s", checkpoint_file, e)
+        global_stats.increment_errors()
+
+def create_executor(config):
+    if config.executor_type == 'process':
+        # Workers are started while parser threads are running. Forking then can copy
+        # a lock held by another thread (e.g. a logging handler) into the child, so use
+        # a fork server where available.
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            return ProcessPoolExecutor(max_workers=config.num_threads, mp_context=multiprocessing.get_context('forkserver'))
+        return ProcessPoolExecutor(max_workers=config.num_threads)
+    return ThreadPoolExecutor(max_workers=config.num_threads)
+
+def create_writer(config, global_stats):
+    if config.output_format == 'files':
+        return OutputWriter(config.io_threads, config.fsync, global_stats)
+    return ArchiveWriter(config.output_folder, config.output_format, config.archive_layout, config.fsync, global_stats)
+
+def submit_mms(executor, record, config, hash_store, writer, global_stats):
+    # Returns the (future, on_result) entry tracked in the pending window for this MMS.
+    if config.executor_type == 'process':
+        if not record.media:
+            return None
+        folder = record.folder
+        output = writer.get_folder(config.output_folder, folder, global_stats)
+        # Known payloads are settled here, so they are never sent to a worker
+        payloads = []
+        fingerprints = []
+        for media in record.media:
+            fingerprint = None
+            if config.payload_index:
+                fingerprint = get_payload_fingerprint(media.data, global_stats)
+                if handle_known_payload(fingerprint, media, output, config, hash_store, writer, global_stats):
+                    continue
+            payloads.append(media)
+            fingerprints.append(fingerprint)
+        if not payloads:
+            return None
+        # Temporary files go next to their final location so they can be renamed into place
+        tmp_dir = output
+        if config.blob_folder is not None:
+            tmp_dir = config.blob_folder
+            writer.makedirs(tmp_dir)
+        elif config.output_format != 'files':
+            tmp_dir = config.output_folder
+        future = executor.submit(decode_media_payloads, payloads, tmp_dir, record.date, config.fsync == 'file')
+        return (future, partial(commit_media_results, folder, output, fingerprints, config, hash_store, writer, global_stats))
+    future = executor.submit(process_mms, record, config, hash_store, writer, global_stats)
+    return (future, partial(finish_mms_writes, config, hash_store))
+
+def iter_mms(input_file, config, global_stats, first_ordinal=0):
+    # Yields (ordinal, record), with record None for MMS the filter skipped. Resuming
+    # part way through a file seeks straight to the first unprocessed record using the
+    # byte-offset index. Files the index doesn't fully cover are parsed in one pass,
+    # so they fail (or not) exactly as they would without the index.
+    if config.parse_shards > 1 or first_ordinal > 0:
+        records, complete = load_mms_index(input_file)
+        if complete:
+            yield from iter_indexed_mms(input_file, records, first_ordinal, config.parse_shards, config.huge_tree,
+                                        config.mms_filter, config.max_in_flight, global_stats)
+            return
+        logging.info("Parsing %s in one pass, as it could not be fully indexed", input_file)
+    with open(input_file, 'rb') as f:
+        source = CountingReader(f, global_stats.bytes_parsed)
+        for record in iter_mms_records(source, config.mms_filter, config.huge_tree, yield_skipped=True):
+            if record.ordinal >= first_ordinal:
+                yield record.ordinal, record if record.selected else None
+
+def iter_timed(records, stage, global_stats):
+    # Adds the time spent waiting for each record to the stage
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                record = next(records)
+            except StopIteration:
+                return
+            global_stats.add_stage_time(stage, time.perf_counter() - start)
+            yield record
+    finally:
+        records.close()
+
+def process_xml_file(input_file, config, executor, in_flight, hash_store, writer, manifest, global_stats):
+    # Parses one XML file and feeds its MMS records to the run-wide executor. in_flight
+    # is a semaphore shared by all files, capping the records held in memory at once.
+    selection = config.mms_filter.describe() if config.mms_filter is not None else None
+    if not config.force and manifest.is_unchanged(input_file, selection):
+        logging.info("Skipping unchanged file: %s", input_file)
+        global_stats.bytes_skipped.add(os.path.getsize(input_file))
+        return
+    file_stats = FileStats(global_stats)
+    fingerprint = get_file_fingerprint(input_file)
+    checkpoint_file = get_checkpoint_file(config.output_folder, fingerprint)
+    checkpoint = load_checkpoint(checkpoint_file, fingerprint, selection) if config.resume else None
+    first_ordinal = 0
+    if checkpoint is not None:
+        if checkpoint["finished"]:
+            logging.info("Skipping completed file: %s", input_file)
+            global_stats.bytes_skipped.add(os.path.getsize(input_file))
+            return
+        first_ordinal = checkpoint["completed"]
+        logging.info("Resuming %s after %d MMS records", input_file, first_ordinal)
+
+    tracker = CheckpointTracker(first_ordinal)
+    pending = deque()
+    finished = False
+    last_checkpoint = time.time()
     logging.info("Parsing: %s", input_file)
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        for _, mms in etree.iterparse(input_file, tag='mms', huge_tree=huge_tree):
-            futures.append(executor.submit(process_mms, mms, output_folder, saved_hashes, saved_hashes_file, write_hash_on, global_stats, lock))
-        for future in as_completed(futures):
+    try:
+        for ordinal, record in iter_timed(iter_mms(input_file, config, file_stats, first_ordinal), 'parse', file_stats):
+            file_stats.records_parsed.add()
+            # Wait for a free slot, collecting this file's finished records meanwhile
+            while not in_flight.try_acquire():
+                generation = in_flight.generation
+                drain_pending(pending, len(pending), file_stats, tracker, in_flight)
+                if in_flight.try_acquire():
+                    break
+                in_flight.wait_for_change(generation)
+            entry = None
             try:
-                future.result()
-            except lxml.etree.XMLSyntaxError as e:
-                logging.error("XML syntax error occurred while parsing the file: %s", str(e))
-                global_stats.increment_errors()
-    if write_hash_on == 'xml':
-        update_saved_hashes(saved_hashes, None, None, saved_hashes_file)
+                if record is not None:
+                    entry = submit_mms(executor, record, config, hash_store, writer, file_stats)
+            except Exception:
+                in_flight.release()
+                raise
+            if entry is None:
+                in_flight.release()
+                tracker.mark_done(ordinal)
+            else:
+                in_flight.add_task(entry[0])
+                pending.append((ordinal,) + entry)
+            drain_pending(pending, in_flight.limit - 1, file_stats, tracker, in_flight)
+            if config.checkpoint_interval and time.time() - last_checkpoint >= config.checkpoint_interval:
+                # Files and hashes are committed first so a checkpoint never runs ahead of them
+                writer.flush()
+                if config.commit_at_checkpoint:
+                    hash_store.commit()
+                save_checkpoint(checkpoint_file, input_file, fingerprint, selection, tracker.completed, False, file_stats)
+                last_checkpoint = time.time()
+        finished = True
+    except etree.XMLSyntaxError as e:
+        logging.error("XML syntax error occurred while parsing the file: %s", str(e))
+        file_stats.increment_errors()
+    finally:
+        drain_pending(pending, 0, file_stats, tracker, in_flight)
+        writer.flush()
+        if config.checkpoint_interval:
+            if config.commit_at_checkpoint:
+                hash_store.commit()
+            save_checkpoint(checkpoint_file, input_file, fingerprint, selection, tracker.completed, finished, file_stats)
+    file_stats.add_stage_time('parse', 0, os.path.getsize(input_file))
+    if config.write_hash_on == 'xml':
+        hash_store.commit()
+    if finished:
+        manifest.record(input_file, fingerprint, file_stats.snapshot(), selection)
+        manifest.save(global_stats)
 
 
-def process_xml_files(input_path, output_folder, num_threads, saved_hashes, saved_hashes_file, max_depth, huge_tree, write_hash_on, global_stats):
-    lock = threading.Lock()
-    xml_files_found = [False]
+def find_xml_files(input_path, max_depth, global_stats):
+    xml_files = []
 
     if max_depth == 1:
         for file in os.listdir(input_path):
             if file.endswith(".xml"):
-                process_xml_file(os.path.join(input_path, file), output_folder, num_threads, saved_hashes, saved_hashes_file, huge_tree, write_hash_on, global_stats, lock, xml_files_found)
+                xml_files.append(os.path.join(input_path, file))
     else:
         for root, dirs, files in os.walk(input_path):
             depth = root[len(input_path):].count(os.path.sep)
@@ -287,12 +1824,446 @@ def process_xml_files(input_path, output_folder, num_threads, saved_hashes, save
             else:
                 for file in files:
                     if file.endswith(".xml"):
-                        process_xml_file(os.path.join(root, file), output_folder, num_threads, saved_hashes, saved_hashes_file, huge_tree, write_hash_on, global_stats, lock, xml_files_found)
+                        xml_files.append(os.path.join(root, file))
 
-    if not xml_files_found[0]:
+    if not xml_files:
         logging.error("No XML files found in the specified input path.")
         global_stats.increment_errors()
         sys.exit(1)
+    return xml_files
+
+def remove_stale_temp_files(output_folder):
+    # Temporary files left in the output folder by a run that was killed: the .name.tmp
+    # files written by workers and write_atomic, and the .tmp copies of archives,
+    # the manifest and checkpoints. None of them is complete, so they are removed.
+    removed = 0
+    for root, _, files in os.walk(output_folder):
+        for file in files:
+            if not file.endswith('.tmp'):
+                continue
+            if not file.startswith('.') and not file[:-len('.tmp')].endswith(('.tar', '.zip', '.json')):
+                continue
+            try:
+                os.remove(os.path.join(root, file))
+                removed += 1
+            except OSError as e:
+                logging.info("Unable to remove temporary file %s: %s", os.path.join(root, file), e)
+    if removed:
+        logging.info("Removed %d temporary files left by an earlier run", removed)
+
+def process_xml_files(input_files, config, hash_store, manifest, global_stats, metrics=None):
+    # Run-level scheduler: one worker pool shared by every file, up to
+    # config.parallel_files files parsed at once, largest first so the biggest
+    # file doesn't end up running alone at the end of the run.
+    sizes = {}
+    for input_file in input_files:
+        try:
+            sizes[input_file] = os.path.getsize(input_file)
+        except OSError as e:
+            logging.error("Exception: %s", e)
+            global_stats.increment_errors()
+    input_files = sorted(sizes, key=sizes.get, reverse=True)
+
+    in_flight = InFlightLimiter(config.max_in_flight)
+    writer = create_writer(config, global_stats)
+    if metrics is not None:
+        metrics.start(in_flight, writer)
+    tuner = None
+    if config.autotune:
+        tuner = AutoTuner(config, in_flight, global_stats)
+        tuner.start()
+    progress = None
+    if config.progress:
+        progress = ProgressReporter(sum(sizes.values()), config.progress_interval, global_stats)
+        progress.start()
+    try:
+        with create_executor(config) as executor, ThreadPoolExecutor(max_workers=config.parallel_files) as file_executor:
+            futures = {file_executor.submit(process_xml_file, input_file, config, executor, in_flight, hash_store, writer, manifest, global_stats): input_file
+                       for input_file in input_files}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error("Exception while processing %s: %s", futures[future], e)
+                    global_stats.increment_errors()
+    finally:
+        writer.close()
+        if metrics is not None:
+            metrics.stop()
+        if progress is not None:
+            progress.stop()
+        if tuner is not None:
+            tuner.stop()
+
+class AutoTuner:
+    # --threads auto: starts with one worker and doubles the workers while the rate at
+    # which the input is parsed keeps improving, then settles on the best setting.
+    # The records held in memory are capped so the process RSS stays within the
+    # memory budget, using the memory used per in-flight record seen so far; going
+    # over the budget halves them and drops a worker.
+    def __init__(self, config, in_flight, global_stats):
+        self.config = config
+        self.in_flight = in_flight
+        self.global_stats = global_stats
+        self.max_workers = config.num_threads
+        self.workers = 1
+        self.limit = min(config.max_in_flight, AUTOTUNE_QUEUE_FACTOR)
+        self.best = None
+        self.best_rate = 0.0
+        self.settled = False
+        self.base_rss = get_rss_bytes()
+        self.record_bytes = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.apply("starting")
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        logging.info("Auto-tuning settled on %d workers and %d MMS records in flight; "
+                     "use --threads %d --max-in-flight %d to start from these settings",
+                     self.workers, self.limit, self.workers, self.limit)
+
+    def apply(self, reason):
+        self.in_flight.resize(self.limit, self.workers)
+        logging.info("Auto-tuning (%s): %d workers, %d MMS records in flight", reason, self.workers, self.limit)
+
+    def memory_limit(self):
+        # Most records in flight that fit in the budget, once a per-record size is known
+        if self.config.memory_budget is None or self.base_rss is None or not self.record_bytes:
+            return self.config.max_in_flight
+        return max(1, int((self.config.memory_budget - self.base_rss) / self.record_bytes))
+
+    def run(self):
+        last_time = time.time()
+        last_parsed = self.global_stats.bytes_parsed.value()
+        while not self.stop_event.wait(AUTOTUNE_INTERVAL):
+            now = time.time()
+            parsed = self.global_stats.bytes_parsed.value()
+            rate = (parsed - last_parsed) / (now - last_time)
+            last_time, last_parsed = now, parsed
+            self.adjust(rate, get_rss_bytes(), self.in_flight.count)
+
+    def adjust(self, rate, rss, in_flight):
+        if rss is not None and self.base_rss is not None and in_flight:
+            self.record_bytes = max(self.record_bytes, (rss - self.base_rss) / in_flight)
+        if rss is not None and self.config.memory_budget is not None and rss > self.config.memory_budget:
+            self.workers = max(1, self.workers - 1)
+            self.limit = max(1, self.limit // 2)
+            self.best_rate = 0.0
+            self.apply("memory use %s over the memory budget" % format_size(rss))
+            return
+        if self.settled or rate <= 0:
+            return
+        if rate > self.best_rate * AUTOTUNE_MIN_GAIN:
+            self.best_rate = rate
+            self.best = (self.workers, self.limit)
+            if self.workers >= self.max_workers:
+                self.settled = True
+                return
+            self.workers = min(self.max_workers, self.workers * 2)
+            reason = "%.1f MB/s" % (rate / (1024 * 1024))
+        else:
+            # No better than the previous setting
+            self.workers, self.limit = self.best
+            self.settled = True
+            reason = "settled at %.1f MB/s" % (self.best_rate / (1024 * 1024))
+        self.limit = max(self.workers, min(self.workers * AUTOTUNE_QUEUE_FACTOR, self.config.max_in_flight, self.memory_limit()))
+        self.apply(reason)
+
+class ProgressReporter:
+    # --progress: shows the share of the input read so far, with records/s, MB/s and
+    # an ETA measured over the last PROGRESS_RATE_WINDOW seconds. Runs in its own
+    # thread and only reads the sharded counters, so it never slows the parsers down.
+    def __init__(self, total_bytes, interval, global_stats, stream=None):
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.global_stats = global_stats
+        self.stream = stream if stream is not None else sys.stderr
+        # On a terminal the line is redrawn in place, otherwise a line is written each time
+        self.redraw = self.stream.isatty()
+        self.started = time.time()
+        self.history = deque([(self.started, 0, 0)])
+        self.last_length = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.report(final=True)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.report()
+
+    def report(self, final=False):
+        now = time.time()
+        parsed = self.global_stats.bytes_parsed.value()
+        done = min(self.total_bytes, parsed + self.global_stats.bytes_skipped.value())
+        records = self.global_stats.records_parsed.value()
+        self.history.append((now, parsed, records))
+        while len(self.history) > 2 and now - self.history[1][0] >= PROGRESS_RATE_WINDOW:
+            self.history.popleft()
+        if final:
+            # Average over the whole run
+            since, parsed_before, records_before = self.started, 0, 0
+        else:
+            since, parsed_before, records_before = self.history[0]
+        elapsed = now - since
+        byte_rate = (parsed - parsed_before) / elapsed if elapsed > 0 else 0
+        record_rate = (records - records_before) / elapsed if elapsed > 0 else 0
+        percent = 100.0 * done / self.total_bytes if self.total_bytes else 100.0
+        line = "%5.1f%% %s of %s, %d MMS, %.0f MMS/s, %.1f MB/s, %d files" % (
+            percent, format_size(done), format_size(self.total_bytes), records, record_rate,
+            byte_rate / (1024 * 1024), self.global_stats.total_files_created)
+        if final:
+            line += ", done in %s" % format_timedelta(datetime.timedelta(seconds=now - self.started))
+        elif byte_rate > 0:
+            line += ", ETA %s" % format_timedelta(datetime.timedelta(seconds=round((self.total_bytes - done) / byte_rate)))
+        if self.redraw:
+            # Pad with spaces to cover the end of a longer previous line
+            self.stream.write("\r" + line.ljust(self.last_length) + ("\n" if final else ""))
+            self.last_length = len(line)
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+def get_rss_bytes():
+    # Current anonymous resident memory (resident minus shared in statm), where /proc is
+    # available. File-backed pages, such as an input file mapped by --parse-shards or
+    # --resume, can be dropped by the kernel at any time, so they aren't counted.
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            fields = f.read().split()
+        return (int(fields[1]) - int(fields[2])) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def get_peak_rss_bytes():
+    # Peak resident set size of the calling process. Worker processes report their own,
+    # as RUSAGE_CHILDREN doesn't include workers started by a forkserver.
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes, except on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+class MetricsReporter:
+    # --metrics-file: samples the pipeline once a second while files are processed,
+    # and writes the stage timings, throughput and samples at the end of the run and,
+    # with --metrics-interval, periodically during it.
+    def __init__(self, config, global_stats):
+        self.config = config
+        self.global_stats = global_stats
+        self.started = time.time()
+        self.in_flight = None
+        self.writer = None
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=METRICS_MAX_SAMPLES)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self, in_flight, writer):
+        self.in_flight = in_flight
+        self.writer = writer
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        last_export = time.time()
+        while not self.stop_event.wait(METRICS_SAMPLE_INTERVAL):
+            self.sample()
+            if self.config.metrics_interval and time.time() - last_export >= self.config.metrics_interval:
+                self.export(False)
+                last_export = time.time()
+
+    def sample(self):
+        tasks = self.in_flight.tasks
+        with self.writer.lock:
+            write_queue = len(self.writer.pending)
+        with self.lock:
+            self.samples.append({"time": round(time.time() - self.started, 3),
+                                 "in_flight": self.in_flight.count,
+                                 "busy_workers": min(tasks, self.config.num_threads),
+                                 "queued_tasks": max(0, tasks - self.config.num_threads),
+                                 "write_queue": write_queue,
+                                 "rss_bytes": get_rss_bytes()})
+
+    def collect(self, complete):
+        elapsed = time.time() - self.started
+        stages = {}
+        for stage, (seconds, num_bytes) in sorted(self.global_stats.stage_snapshot().items()):
+            stages[stage] = {"seconds": round(seconds, 6), "bytes": num_bytes,
+                             "mb_per_s": round(num_bytes / seconds / 1e6, 3) if seconds and num_bytes else None}
+        worker_seconds = stages.get("worker", {}).get("seconds", 0.0)
+        with self.lock:
+            samples = list(self.samples)
+        with self.global_stats.lock:
+            peak_worker_rss = self.global_stats.peak_worker_rss
+        return {"complete": complete,
+                "run_seconds": round(elapsed, 3),
+                "counters": self.global_stats.snapshot(),
+                "stages": stages,
+                "input_bytes": stages.get("parse", {}).get("bytes", 0),
+                "output_bytes": stages.get("write", {}).get("bytes", 0),
+                "input_mb_per_s": round(stages.get("parse", {}).get("bytes", 0) / elapsed / 1e6, 3) if elapsed else None,
+                "output_mb_per_s": round(stages.get("write", {}).get("bytes", 0) / elapsed / 1e6, 3) if elapsed else None,
+                "worker_utilization": round(worker_seconds / (elapsed * self.config.num_threads), 3) if elapsed else None,
+                "max_in_flight": max((sample["in_flight"] for sample in samples), default=0),
+                "peak_rss_bytes": get_peak_rss_bytes(),
+                "peak_worker_rss_bytes": peak_worker_rss,
+                "samples": samples}
+
+    def format_prometheus(self, metrics):
+        lines = []
+
+        def add(name, metric_type, help_text, values):
+            lines.append("# HELP %s%s %s" % (METRICS_PREFIX, name, help_text))
+            lines.append("# TYPE %s%s %s" % (METRICS_PREFIX, name, metric_type))
+            for labels, value in values:
+                if value is not None:
+                    lines.append("%s%s%s %s" % (METRICS_PREFIX, name, labels, value))
+
+        stages = metrics["stages"]
+        add("stage_seconds_total", "counter", "Cumulative time spent in each pipeline stage",
+            [('{stage="%s"}' % stage, values["seconds"]) for stage, values in stages.items()])
+        add("stage_bytes_total", "counter", "Bytes handled by each pipeline stage",
+            [('{stage="%s"}' % stage, values["bytes"]) for stage, values in stages.items()])
+        for key, value in metrics["counters"].items():
+            add(key + "_total", "counter", "Number of " + key.replace('_', ' '), [("", value)])
+        last_sample = metrics["samples"][-1] if metrics["samples"] else {}
+        for name, metric_type, help_text, value in [
+                ("run_complete", "gauge", "1 once the run has finished", int(metrics["complete"])),
+                ("run_seconds", "gauge", "Time since the run started", metrics["run_seconds"]),
+                ("input_throughput_bytes_per_second", "gauge", "XML input parsed per second of the run",
+                 metrics["input_bytes"] / metrics["run_seconds"] if metrics["run_seconds"] else None),
+                ("output_throughput_bytes_per_second", "gauge", "Decoded media written per second of the run",
+                 metrics["output_bytes"] / metrics["run_seconds"] if metrics["run_seconds"] else None),
+                ("worker_utilization_ratio", "gauge", "Share of worker time spent processing records", metrics["worker_utilization"]),
+                ("in_flight_records", "gauge", "MMS records held in memory at the last sample", last_sample.get("in_flight")),
+                ("in_flight_records_max", "gauge", "Most MMS records held in memory in any sample", metrics["max_in_flight"]),
+                ("busy_workers", "gauge", "Workers processing a record at the last sample", last_sample.get("busy_workers")),
+                ("write_queue_length", "gauge", "Files waiting for the writer at the last sample", last_sample.get("write_queue")),
+                ("peak_rss_bytes", "gauge", "Peak resident memory of the main process", metrics["peak_rss_bytes"]),
+                ("peak_worker_rss_bytes", "gauge", "Peak resident memory of any worker process", metrics["peak_worker_rss_bytes"])]:
+            add(name, metric_type, help_text, [("", value)])
+        return "\n".join(lines) + "\n"
+
+    def export(self, complete=True):
+        # Written to a temporary file and renamed, as the Prometheus textfile collector expects.
+        metrics = self.collect(complete)
+        if self.config.metrics_format == 'prometheus':
+            text = self.format_prometheus(metrics)
+        else:
+            text = json.dumps(metrics, indent=1)
+        try:
+            tmpfile = self.config.metrics_file + '.tmp'
+            with open(tmpfile, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmpfile, self.config.metrics_file)
+        except IOError as e:
+            logging.error("Unable to write metrics file %s: %s", self.config.metrics_file, e)
+            self.global_stats.increment_errors()
+
+class Inventory:
+    # Per-folder totals for --inventory. Sizes are estimated from the base64 text and
+    # duplicates are recognised by payload fingerprint, so nothing is decoded.
+    def __init__(self):
+        self.folders = {}
+        self.seen = set()
+
+    def add(self, folder, size, fingerprint, saved):
+        entry = self.folders.setdefault(folder, {"attachments": 0, "bytes": 0, "duplicates": 0,
+                                                 "already_saved": 0, "new_files": 0, "new_bytes": 0})
+        entry["attachments"] += 1
+        entry["bytes"] += size
+        if saved:
+            entry["already_saved"] += 1
+        elif fingerprint is not None and (folder, fingerprint) in self.seen:
+            entry["duplicates"] += 1
+        else:
+            entry["new_files"] += 1
+            entry["new_bytes"] += size
+        if fingerprint is not None:
+            self.seen.add((folder, fingerprint))
+
+    def totals(self):
+        totals = {}
+        for entry in self.folders.values():
+            for key, value in entry.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+def inventory_mms(record, config, hash_store, inventory):
+    folder = record.folder
+    for media in record.media:
+        if media.data is None:
+            continue
+        # Always fingerprinted: nothing is decoded here, so it is the only way to spot duplicates
+        fingerprint = get_payload_fingerprint(media.data)
+        saved = False
+        if fingerprint is not None and hash_store is not None:
+            sha256 = hash_store.lookup_payload(fingerprint)
+            saved = sha256 is not None and hash_store.contains(folder, sha256)
+        inventory.add(folder, media.size, fingerprint, saved)
+
+def inventory_xml_file(input_file, config, hash_store, manifest, inventory, global_stats):
+    selection = config.mms_filter.describe() if config.mms_filter is not None else None
+    if not config.force and manifest.is_unchanged(input_file, selection):
+        logging.info("Skipping unchanged file: %s", input_file)
+        return
+    logging.info("Inventory: %s", input_file)
+    try:
+        for _, record in iter_mms(input_file, config, global_stats):
+            if record is not None:
+                inventory_mms(record, config, hash_store, inventory)
+    except etree.XMLSyntaxError as e:
+        logging.error("XML syntax error occurred while parsing the file: %s", str(e))
+        global_stats.increment_errors()
+
+def format_size(num_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if num_bytes < 1024:
+            return f'{num_bytes:.1f} {unit}' if unit != 'B' else f'{num_bytes} {unit}'
+        num_bytes /= 1024
+    return f'{num_bytes:.1f} TB'
+
+def print_inventory(inventory, inventory_format, global_stats):
+    totals = inventory.totals()
+    if inventory_format == 'json':
+        print(json.dumps({"folders": inventory.folders, "totals": totals, "errors": global_stats.total_errors,
+                          "run_time": time.time() - start_time}, indent=1, sort_keys=True))
+        return
+    table = PrettyTable()
+    table.field_names = ["Folder", "Attachments", "Size", "Duplicates", "Already Saved", "New Files", "New Size"]
+    table.align["Folder"] = "l"
+    rows = [(folder, inventory.folders[folder]) for folder in sorted(inventory.folders)]
+    if totals:
+        rows.append(("Total", totals))
+    for folder, entry in rows:
+        table.add_row([folder, entry["attachments"], format_size(entry["bytes"]), entry["duplicates"],
+                       entry["already_saved"], entry["new_files"], format_size(entry["new_bytes"])])
+    print(table)
+    print("Run Time: %s, Errors: %d" % (format_timedelta(datetime.timedelta(seconds=(time.time() - start_time))),
+                                       global_stats.total_errors))
 
 def format_timedelta(td):
     days, seconds = td.days, td.seconds
@@ -312,32 +2283,89 @@ def format_timedelta(td):
     else:
         return f'{milliseconds}ms'
 
-def main(input_paths, output_folder, num_threads, saved_hashes_file, max_depth, huge_tree, write_hash_on, log_to_console):
-    global_stats = GlobalStats()
-    initialize_logging(log_to_console)
+def parse_threads(value):
+    if value == 'auto':
+        return value
     try:
-        saved_hashes = load_saved_hashes(saved_hashes_file, global_stats)
-    except IOError as e:
-        logging.error("Unable to read saved hashes file: %s", e)
-        global_stats.increment_errors()
-        sys.exit(1)
+        threads = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid thread count '%s', expected a number or 'auto'" % value)
+    if threads < 1:
+        raise argparse.ArgumentTypeError("thread count must be at least 1")
+    return threads
+
+def parse_size(value):
+    # A byte count with an optional K, M, G or T suffix (powers of 1024)
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    number = value.strip().upper().rstrip('B')
+    scale = 1
+    if number and number[-1] in units:
+        scale = units[number[-1]]
+        number = number[:-1]
+    try:
+        return int(float(number) * scale)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size '%s', expected e.g. 512M or 4G" % value)
 
-    lock = threading.Lock()
-    xml_files_found = [False]
+def get_physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date '%s', expected YYYY-MM-DD" % value)
 
+def run_inventory(input_files, config, global_stats):
+    # Read-only: nothing is created in the output folder, and attachments are only
+    # counted as already saved if a saved hashes file from an earlier run exists. A
+    # saved_hashes.pkl that the first normal run would import is read directly.
+    hash_store = None
+    legacy_file = os.path.splitext(config.saved_hashes_file)[0] + '.pkl'
+    if os.path.exists(config.saved_hashes_file):
+        hash_store = open_hash_store(config.hash_store_type, config.saved_hashes_file, global_stats, read_only=True)
+    elif config.hash_store_type == 'sqlite' and os.path.exists(legacy_file):
+        hash_store = PickleHashStore(legacy_file, global_stats, read_only=True)
+    manifest = Manifest(os.path.join(config.output_folder, MANIFEST_FILE))
+    inventory = Inventory()
+    for input_file in input_files:
+        inventory_xml_file(input_file, config, hash_store, manifest, inventory, global_stats)
+    if hash_store is not None:
+        hash_store.close()
+    print_inventory(inventory, config.inventory, global_stats)
+
+def main(input_paths, config, log_to_console):
+    global_stats = GlobalStats()
+    initialize_logging(log_to_console)
+
+    input_files = []
     for input_path in input_paths:
         if os.path.isdir(input_path):
-            try:
-                process_xml_files(input_path, output_folder, num_threads, saved_hashes, saved_hashes_file, max_depth, huge_tree, write_hash_on, global_stats)
-            except Exception as e:
-                logging.error("Exception: %s", e)
-                global_stats.increment_errors()
+            input_files.extend(find_xml_files(input_path, config.max_depth, global_stats))
         else:
-            try:
-                process_xml_file(input_path, output_folder, num_threads, saved_hashes, saved_hashes_file, huge_tree, write_hash_on, global_stats, lock, xml_files_found)
-            except Exception as e:
-                logging.error("Exception: %s", e)
-                global_stats.increment_errors()
+            input_files.append(input_path)
+
+    if config.inventory is not None:
+        run_inventory(input_files, config, global_stats)
+        return
+
+    if not os.path.exists(config.output_folder):
+        os.makedirs(config.output_folder)
+    else:
+        remove_stale_temp_files(config.output_folder)
+    hash_store = open_hash_store(config.hash_store_type, config.saved_hashes_file, global_stats)
+    manifest = Manifest(os.path.join(config.output_folder, MANIFEST_FILE))
+
+    metrics = MetricsReporter(config, global_stats) if config.metrics_file else None
+    process_xml_files(input_files, config, hash_store, manifest, global_stats, metrics)
+
+    hash_store.close()
+    manifest.save(global_stats)
+    if metrics is not None:
+        metrics.export()
 
     # display summary
     table = PrettyTable()
@@ -359,10 +2387,35 @@ if __name__ == "__main__":
                         help='Path(s) to the input XML file(s) or directory containing XML files')
     parser.add_argument('output_folder', type=str,
                         help='Path to the output folder')
-    parser.add_argument('--threads', type=int, default=1,
-                        help='Number of threads to use (default: 1)')
+    parser.add_argument('--threads', '--workers', dest='threads', type=parse_threads, default=1,
+                        help="Number of worker threads or processes to use, or 'auto' to tune it during the run (default: 1)")
+    parser.add_argument('--memory-budget', type=parse_size, default=None,
+                        help='With --threads auto, keep the memory used below this size, e.g. 4G (default: half of physical memory)')
+    parser.add_argument('--executor', type=str, default='thread',
+                        choices=['thread', 'process'],
+                        help='Run decoding, hashing and writing in threads or in separate processes (default: thread)')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help='Maximum number of MMS records held in memory at once, across all files (default: 4 x threads)')
+    parser.add_argument('--io-threads', type=int, default=4,
+                        help='Number of threads writing extracted files to the output folder (default: 4)')
+    parser.add_argument('--fsync', type=str, default='none',
+                        choices=['none', 'file', 'batch'],
+                        help='When to flush written files to disk: never, after each file, or in batches (default: none)')
+    parser.add_argument('--output-format', type=str, default='files',
+                        choices=['files', 'tar', 'zip'],
+                        help='Write media as separate files, or append it to uncompressed tar or zip archives (default: files)')
+    parser.add_argument('--archive-layout', type=str, default='contact',
+                        choices=['contact', 'single'],
+                        help='With --output-format tar/zip, one archive per contact or a single archive with a folder per contact (default: contact)')
+    parser.add_argument('--parallel-files', type=int, default=1,
+                        help='Number of XML files to parse at the same time, largest first (default: 1)')
+    parser.add_argument('--parse-shards', type=int, default=1,
+                        help='Number of parser threads per XML file, using a byte-offset index of the MMS records (default: 1)')
     parser.add_argument('--saved-hashes', type=str, default=None,
-                        help='Path to the saved_hashes file (default: output_folder/saved_hashes.pkl)')
+                        help='Path to the saved_hashes file (default: output_folder/saved_hashes.db, or saved_hashes.pkl with --hash-store pickle)')
+    parser.add_argument('--hash-store', type=str, default='sqlite',
+                        choices=['sqlite', 'pickle'],
+                        help='Storage format for the saved hashes (default: sqlite)')
     parser.add_argument('--max-depth', type=int, default=1,
                         help='Maximum directory depth to search for XML files (default: 1)')
     parser.add_argument('--huge-tree', action='store_true',
@@ -370,14 +2423,95 @@ if __name__ == "__main__":
     parser.add_argument('--write-hash-on', type=str, default='media',
                         choices=['media', 'mms', 'xml', 'run'],
                         help='When to update the saved_hashes file (default: media)')
+    parser.add_argument('--payload-index', action='store_true',
+                        help="Recognise attachments saved by earlier runs by their base64 text, without decoding them")
+    parser.add_argument('--content-store', action='store_true',
+                        help='Write each unique file once to output_folder/.blobs and hardlink it into the contact folders')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue each XML file from its last checkpoint instead of from the beginning')
+    parser.add_argument('--checkpoint-interval', type=int, default=CHECKPOINT_INTERVAL,
+                        help='Seconds between progress checkpoints, 0 to disable (default: %d)' % CHECKPOINT_INTERVAL)
+    parser.add_argument('--force', action='store_true',
+                        help='Process every XML file, even those recorded as unchanged in the output manifest')
+    parser.add_argument('--since', type=parse_date, default=None,
+                        help='Only extract MMS sent or received on or after this date (YYYY-MM-DD)')
+    parser.add_argument('--until', type=parse_date, default=None,
+                        help='Only extract MMS sent or received on or before this date (YYYY-MM-DD)')
+    parser.add_argument('--contact', type=str, action='append', default=None,
+                        help='Only extract MMS from contacts whose name or number matches this pattern (wildcards allowed, repeatable)')
+    parser.add_argument('--type', dest='media_types', type=str, action='append', default=None,
+                        help='Only extract media of this type: image, video or a MIME type pattern such as image/gif (repeatable, default: image and video)')
+    parser.add_argument('--inventory', action='store_true',
+                        help='Report the attachments each folder would receive, without decoding or writing anything')
+    parser.add_argument('--inventory-format', type=str, default='table',
+                        choices=['table', 'json'],
+                        help='Output format of --inventory (default: table)')
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help='Write per-stage timings, throughput and resource samples to this file at the end of the run')
+    parser.add_argument('--metrics-format', type=str, default='json',
+                        choices=['json', 'prometheus'],
+                        help='Format of the metrics file: JSON or a Prometheus textfile (default: json)')
+    parser.add_argument('--metrics-interval', type=int, default=0,
+                        help='Also write the metrics file every this many seconds during the run, 0 for only at the end (default: 0)')
+    parser.add_argument('--progress', action='store_true',
+                        help='Show the share of the input read, MMS/s, MB/s and the time remaining while running')
+    parser.add_argument('--progress-interval', type=float, default=1.0,
+                        help='Seconds between progress updates (default: 1)')
     parser.add_argument('--log-to-console', action='store_true',
                     help='Log to console in addition to the log file')
 
     args = parser.parse_args()
+    if args.content_store and args.output_format != 'files':
+        parser.error("--content-store can't be combined with --output-format %s" % args.output_format)
 
     if args.saved_hashes is None:
-        saved_hashes_file = os.path.join(args.output_folder, 'saved_hashes.pkl')
+        saved_hashes_name = 'saved_hashes.pkl' if args.hash_store == 'pickle' else 'saved_hashes.db'
+        saved_hashes_file = os.path.join(args.output_folder, saved_hashes_name)
+    elif args.hash_store == 'sqlite' and args.saved_hashes.endswith('.pkl'):
+        # An existing pickle is imported into a database alongside it
+        saved_hashes_file = os.path.splitext(args.saved_hashes)[0] + '.db'
     else:
         saved_hashes_file = args.saved_hashes
 
-    main(args.input_path, args.output_folder, args.threads, saved_hashes_file, args.max_depth, args.huge_tree, args.write_hash_on, args.log_to_console)
+    autotune = args.threads == 'auto'
+    memory_budget = None
+    if autotune:
+        # Workers are started as the tuner asks for them, up to this many
+        if args.executor == 'process':
+            num_threads = os.cpu_count() or 1
+        else:
+            num_threads = min(32, (os.cpu_count() or 1) + 4)
+        memory_budget = args.memory_budget
+        if memory_budget is None and get_physical_memory() is not None:
+            memory_budget = get_physical_memory() // 2
+    else:
+        num_threads = args.threads
+
+    if args.max_in_flight is None:
+        max_in_flight = num_threads * 4
+    else:
+        max_in_flight = max(1, args.max_in_flight)
+
+    mms_filter = None
+    if args.since or args.until or args.contact or args.media_types:
+        since = args.since.timestamp() * 1000 if args.since else None
+        # --until includes the whole of the given day
+        until = (args.until + datetime.timedelta(days=1)).timestamp() * 1000 if args.until else None
+        mms_filter = MmsFilter(since, until, args.contact, args.media_types)
+
+    config = RunConfig(args.output_folder, num_threads=num_threads, executor_type=args.executor,
+                       max_in_flight=max_in_flight, parse_shards=args.parse_shards,
+                       hash_store_type=args.hash_store, saved_hashes_file=saved_hashes_file,
+                       max_depth=args.max_depth, huge_tree=args.huge_tree, write_hash_on=args.write_hash_on,
+                       content_store=args.content_store, resume=args.resume,
+                       checkpoint_interval=args.checkpoint_interval, force=args.force,
+                       parallel_files=max(1, args.parallel_files), payload_index=args.payload_index,
+                       mms_filter=mms_filter, inventory=args.inventory_format if args.inventory else None,
+                       io_threads=max(1, args.io_threads), fsync=args.fsync,
+                       output_format=args.output_format, archive_layout=args.archive_layout,
+                       metrics_file=args.metrics_file, metrics_format=args.metrics_format,
+                       metrics_interval=max(0, args.metrics_interval),
+                       progress=args.progress, progress_interval=max(0.1, args.progress_interval),
+                       autotune=autotune, memory_budget=memory_budget)
+
+    main(args.input_path, config, args.log_to_console)
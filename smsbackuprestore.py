@@ -0,0 +1,286 @@
+# SMSBackupRestore parser
+#
+# smsbackuprestore.py
+#
+# Streaming reader for XML backups of the Android application "SMS Backup & Restore",
+# shared by smsbackuprestore-extractor.py and usable on its own:
+#
+#   import smsbackuprestore
+#
+#   for media in smsbackuprestore.iter_media("backup.xml"):
+#       print(media.folder, media.content_type, media.filename, media.size)
+#       save(media.payload)
+#
+# Records are plain objects holding the attribute values they need. The lxml elements
+# they were read from are freed as soon as each record is built, so memory use stays
+# flat however large the backup is. Attachments stay base64-encoded until their
+# payload or hash is asked for.
+#
+# Requires lxml (pip install lxml).
+
+import base64
+import datetime
+import fnmatch
+import hashlib
+import json
+import logging
+
+from lxml import etree
+
+__all__ = ["MmsFilter", "MmsRecord", "MediaRecord", "iter_mms", "iter_media", "CountingReader",
+           "decode_payload", "get_decoded_size", "get_folder_name", "get_media_filename", "get_media_list",
+           "release_mms"]
+
+logger = logging.getLogger(__name__)
+
+# Shorthands accepted by MmsFilter media types
+MEDIA_TYPE_ALIASES = {"image": "image/*", "video": "video/*"}
+
+# Define the MmsFilter class, selecting MMS records by date, contact and media type
+class MmsFilter:
+    def __init__(self, since=None, until=None, contacts=None, media_types=None):
+        # since/until are millisecond timestamps, like the <mms> date attribute; until is exclusive
+        self.since = since
+        self.until = until
+        self.contacts = [contact.lower() for contact in contacts] if contacts else None
+        self.media_types = [MEDIA_TYPE_ALIASES.get(t.lower(), t.lower()) for t in media_types] if media_types else None
+
+    def matches_record(self, date, address, contact_name):
+        # Only needs the <mms> start tag attributes, so it can run before the parts are parsed.
+        if self.since is not None or self.until is not None:
+            try:
+                date = float(date)
+            except (TypeError, ValueError):
+                return False
+            if self.since is not None and date < self.since:
+                return False
+            if self.until is not None and date >= self.until:
+                return False
+        if self.contacts is not None:
+            names = []
+            if contact_name is not None and contact_name != "(Unknown)":
+                names.append(contact_name)
+                names.extend(contact_name.split(", "))
+            if address is not None:
+                names.append(address)
+                names.extend(address.split("~"))
+            names = [name.strip().lower() for name in names]
+            if not any(fnmatch.fnmatchcase(name, pattern) for name in names for pattern in self.contacts):
+                return False
+        return True
+
+    def matches_type(self, content_type):
+        if self.media_types is None:
+            return content_type is not None and content_type.startswith(('image', 'video'))
+        if content_type is None:
+            return False
+        content_type = content_type.lower()
+        return any(fnmatch.fnmatchcase(content_type, pattern) for pattern in self.media_types)
+
+    def describe(self):
+        # Stable description stored in checkpoints and the manifest, so progress made
+        # with one selection is not mistaken for another.
+        return json.dumps({"since": self.since, "until": self.until,
+                           "contacts": self.contacts, "types": self.media_types}, sort_keys=True)
+
+class MediaRecord:
+    # One image or video part of an MMS. The base64 text is kept as read; it is only
+    # decoded when payload, sha256 or (for parts without a name) filename is first
+    # used, and the decoded bytes are then kept on the record so it is decoded once.
+    __slots__ = ('folder', 'date', 'content_type', 'name', 'part_date', 'data', '_payload', '_sha256')
+
+    def __init__(self, folder, date, content_type, name, part_date, data):
+        self.folder = folder
+        # Date of the MMS, in milliseconds as a string, as in the backup
+        self.date = date
+        self.content_type = content_type
+        # File name given in the backup ("null" if none) and the part's own date attribute
+        self.name = name
+        self.part_date = part_date
+        self.data = data
+        self._payload = None
+        self._sha256 = None
+
+    @property
+    def payload(self):
+        # The decoded file
+        return self.decode()
+
+    @property
+    def sha256(self):
+        if self._sha256 is None:
+            self.decode()
+        return self._sha256
+
+    @property
+    def size(self):
+        # Decoded size, worked out from the base64 text without decoding it
+        return get_decoded_size(self.data)
+
+    @property
+    def filename(self):
+        # The name the extractor saves this file under
+        if self.name == "null":
+            return get_media_filename(self.name, self.content_type, self.part_date, self.sha256)
+        return self.name
+
+    @property
+    def timestamp(self):
+        return datetime.datetime.fromtimestamp(float(self.date) / 1000.0)
+
+    def decode(self):
+        # Decode the payload if not done yet, keeping it on the record along with its hash
+        if self._payload is None:
+            self._payload, self._sha256 = decode_payload(self.data)
+        return self._payload
+
+    def __repr__(self):
+        return "MediaRecord(folder=%r, date=%r, content_type=%r, name=%r, size=%d)" % (
+            self.folder, self.date, self.content_type, self.name, self.size)
+
+class MmsRecord:
+    # One <mms> record. ordinal is its position among the <mms> records of the file.
+    # selected is False for records rejected by the filter, which have no media.
+    __slots__ = ('ordinal', 'date', 'address', 'contact_name', 'folder', 'media', 'selected')
+
+    def __init__(self, ordinal, date, address, contact_name, folder, media, selected=True):
+        self.ordinal = ordinal
+        self.date = date
+        self.address = address
+        self.contact_name = contact_name
+        self.folder = folder
+        self.media = media
+        self.selected = selected
+
+    @classmethod
+    def from_element(cls, mms, ordinal=None, mms_filter=None):
+        # Copies what is needed from an <mms> element; the element can be freed afterwards.
+        folder = get_folder_name(mms)
+        date = mms.get("date")
+        media = [MediaRecord(folder, date, part.get("ct"), part.get("cl"), part.get("date"), part.get("data"))
+                 for part in get_media_list(mms, mms_filter)]
+        return cls(ordinal, date, mms.get("address"), mms.get("contact_name"), folder, media)
+
+    @classmethod
+    def skipped(cls, ordinal, date, address, contact_name):
+        return cls(ordinal, date, address, contact_name, None, [], selected=False)
+
+    def __repr__(self):
+        return "MmsRecord(ordinal=%r, date=%r, folder=%r, media=%d)" % (self.ordinal, self.date, self.folder, len(self.media))
+
+class CountingReader:
+    # File object for iterparse that counts the bytes read. counter is anything with
+    # an add(n) method.
+    def __init__(self, f, counter):
+        self.f = f
+        self.counter = counter
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.counter.add(len(data))
+        return data
+
+def get_media_list(mms, mms_filter=None):
+    if mms_filter is None:
+        return mms.xpath(".//part[starts-with(@ct, 'image') or starts-with(@ct, 'video')]")
+    # Parts emptied by the parser have no attributes left, so the data check skips those too
+    return [part for part in mms.iter('part') if part.get("data") is not None and mms_filter.matches_type(part.get("ct"))]
+
+def get_folder_name(mms):
+    address = mms.get("address")
+    contact = mms.get("contact_name")
+    if contact == "(Unknown)":
+        folder = address if address is not None else "Unknown"
+    else:
+        folder = contact
+    return folder
+
+def get_media_filename(filename, content_type, date, sha256):
+    if filename == "null":
+        name = content_type
+        ext = name.split('/')[1]
+        if ext == "jpeg":
+            ext = "jpg"
+        elif name == "image/*":
+            logger.info("Unknown image type * for MMS content; guessing .jpg %s", sha256)
+            ext = "jpg"
+        elif name == "video/*":
+            logger.info("Unknown video type * for MMS content; guessing .3gpp %s", sha256)
+            ext = "3gpp"
+        if date is None:
+            # handle the case where date is None, e.g., set a default date or skip this item
+            timestamp = datetime.datetime.now()
+        else:
+            timestamp = datetime.datetime.fromtimestamp(float(date) / 1000.0)
+
+        filename = timestamp.strftime("%Y%m%d_%H%M%S%f") + '_' + sha256[:5] + '.' + ext
+    return filename
+
+def decode_payload(data):
+    # Returns (decoded bytes, SHA256 hex digest)
+    rawdata = base64.b64decode(data)
+    return rawdata, hashlib.sha256(rawdata).hexdigest()
+
+def get_decoded_size(data):
+    # Exact for base64 without line breaks, which is how the backup stores attachments.
+    padding = 2 if data.endswith('==') else 1 if data.endswith('=') else 0
+    return len(data) * 3 // 4 - padding
+
+def release_mms(mms):
+    # Free a processed MMS along with any earlier siblings (including <sms> records)
+    # so the tree built by iterparse does not keep growing.
+    mms.clear()
+    parent = mms.getparent()
+    if parent is not None:
+        while mms.getprevious() is not None:
+            del parent[0]
+
+def iter_mms(source, mms_filter=None, huge_tree=False, yield_skipped=False):
+    # Yields an MmsRecord for each <mms> in source, a file name or a binary file object.
+    # Each <mms> is freed once its record is built and each <sms> as soon as it ends,
+    # with or without a filter, so neither builds up in memory.
+    # With a filter, each <mms> start tag is checked before its parts are parsed, and
+    # the parts of records that don't match, or of other media types, are emptied as
+    # soon as they end, so their base64 data is dropped straight away. Records the
+    # filter rejects are skipped, or yielded with selected=False if yield_skipped is set.
+    # Raises lxml.etree.XMLSyntaxError if the XML is malformed.
+    ordinal = 0
+    if mms_filter is None:
+        for _, elem in etree.iterparse(source, tag=('sms', 'mms'), huge_tree=huge_tree):
+            if elem.tag == 'sms':
+                release_mms(elem)
+                continue
+            record = MmsRecord.from_element(elem, ordinal)
+            release_mms(elem)
+            yield record
+            ordinal += 1
+        return
+    selected = False
+    for event, elem in etree.iterparse(source, events=('start', 'end'), tag=('sms', 'mms', 'part'), huge_tree=huge_tree):
+        if elem.tag == 'mms':
+            if event == 'start':
+                selected = mms_filter.matches_record(elem.get("date"), elem.get("address"), elem.get("contact_name"))
+                continue
+            if selected:
+                record = MmsRecord.from_element(elem, ordinal, mms_filter)
+            else:
+                record = MmsRecord.skipped(ordinal, elem.get("date"), elem.get("address"), elem.get("contact_name"))
+            release_mms(elem)
+            if selected or yield_skipped:
+                yield record
+            ordinal += 1
+        elif event == 'end':
+            if elem.tag == 'sms':
+                release_mms(elem)
+            elif not selected or not mms_filter.matches_type(elem.get("ct")):
+                elem.clear()
+
+def iter_media(source, decode=False, mms_filter=None, huge_tree=False):
+    # Yields a MediaRecord for each image or video (or each attachment selected by
+    # mms_filter) in source. With decode=True the payload is decoded up front and
+    # kept on the record.
+    for record in iter_mms(source, mms_filter, huge_tree):
+        for media in record.media:
+            if decode:
+                media.decode()
+            yield media
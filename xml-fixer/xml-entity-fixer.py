@@ -1,10 +1,15 @@
 import argparse
+import codecs
 import io
+import mmap
+import multiprocessing
 import os
 import re
 import struct
 import sys
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 # Regular expression for matching numeric XML entities, e.g. "&#55357;&#56860;".
 rgx1 = re.compile(r"(?:&#\d+;)+")
@@ -15,6 +20,31 @@ rgx2 = re.compile(r"&#(\d+);")
 # Per "struct" module docs, 'H' format character is used to read or write two-byte unsigned numbers.
 UNSIGNED_SHORT = "H"
 
+# Byte engine: a run of numeric entities, decimal or hexadecimal, and one entity in it.
+# The first entity is spelled out so the pattern starts with the literal "&#", which
+# lets the regex engine skip ahead to candidates instead of trying every position.
+ENTITY_RUN = re.compile(rb"&#(?:[0-9]+|x[0-9a-fA-F]+);(?:&#(?:[0-9]+|x[0-9a-fA-F]+);)*")
+ENTITY = re.compile(rb"&#(x?)([0-9a-fA-F]+);")
+
+# An entity cut off at the end of a window, e.g. "&", "&#" or "&#5535".
+PARTIAL_ENTITY = re.compile(rb"&(?:#(?:[0-9]*|x[0-9a-fA-F]*))?")
+
+# Longest partial entity looked for at the end of a window. Longer digit strings can't
+# be a UTF-16 code unit anyway.
+MAX_PARTIAL_ENTITY = 16
+
+CDATA_START = b"<![CDATA["
+CDATA_END = b"]]>"
+
+# What a lone surrogate entity is replaced with: U+FFFD REPLACEMENT CHARACTER.
+REPLACEMENT_CHARACTER = "\ufffd".encode("utf-8")
+
+# Byte engine window, used when --chunk-size isn't given.
+DEFAULT_WINDOW_KB = 16 * 1024
+
+# Cached replacements of entity runs; the same few emoji make up most of them.
+MAX_CACHED_RUNS = 100000
+
 def print_progress_bar(completed, total, length=50):
     # Calculate progress as a percentage.
     progress = int(length * completed / total)
@@ -56,43 +86,240 @@ def fix_codepoints(s, raw=False):
         out.write(s[i:])
         return out.getvalue()
 
-def process_file(input_file, output_file, chunk_size_kb=64, input_encoding='utf-8', output_encoding='utf-8'):
+class ByteEntityFixer:
+    # Byte engine. Rewrites the entities of UTF-16 surrogates, which are not valid XML:
+    # a high and low surrogate pair becomes the UTF-8 bytes of the character it encodes,
+    # a lone surrogate becomes U+FFFD. Other entities are valid and are left as they are,
+    # as is everything inside CDATA sections. Input is fed in windows of bytes; feed()
+    # returns how far it got, and the rest is fed again with the next window, so an
+    # entity or CDATA delimiter cut off at the end of a window is never split.
+    def __init__(self):
+        self.in_cdata = False
+        self.changes_made = 0
+        self.cache = {}
+
+    def feed(self, buf, pos, end, final, write):
+        # Process buf[pos:end], writing the output with write(). buf can be bytes or an
+        # mmap. final means no more input follows end. Returns the offset up to which
+        # the input was consumed.
+        view = memoryview(buf)
+        try:
+            while pos < end:
+                if self.in_cdata:
+                    close = buf.find(CDATA_END, pos, end)
+                    if close < 0:
+                        # Keep the last bytes back in case they start "]]>"
+                        stop = end if final else max(pos, end - len(CDATA_END) + 1)
+                        write(view[pos:stop])
+                        return stop
+                    write(view[pos:close + len(CDATA_END)])
+                    pos = close + len(CDATA_END)
+                    self.in_cdata = False
+                    continue
+                cdata = buf.find(CDATA_START, pos, end)
+                if cdata < 0:
+                    limit = end if final else end - partial_suffix(buf, pos, end, CDATA_START)
+                    pos = self.fix_entities(buf, view, pos, limit, final, write)
+                    return pos
+                # The text before a CDATA section ends there, so nothing in it is cut off
+                self.fix_entities(buf, view, pos, cdata, True, write)
+                write(view[cdata:cdata + len(CDATA_START)])
+                pos = cdata + len(CDATA_START)
+                self.in_cdata = True
+            return pos
+        finally:
+            view.release()
+
+    def fix_entities(self, buf, view, pos, limit, complete, write):
+        # Fix the entity runs in buf[pos:limit]. Unless complete, an entity run or
+        # partial entity reaching limit could continue in the next window; it is not
+        # consumed. Returns the offset up to which the input was consumed.
+        if not complete:
+            partial = buf.rfind(b"&", max(pos, limit - MAX_PARTIAL_ENTITY), limit)
+            if partial >= 0 and PARTIAL_ENTITY.fullmatch(buf, partial, limit):
+                limit = partial
+            else:
+                partial = -1
+        for m in ENTITY_RUN.finditer(buf, pos, limit):
+            if not complete and m.end() == limit:
+                # May continue after limit, e.g. with the low half of a surrogate pair
+                write(view[pos:m.start()])
+                return m.start()
+            run = m.group()
+            fixed = self.cache.get(run, run)
+            if fixed is run:
+                fixed = fix_entity_run(run)
+                if len(self.cache) >= MAX_CACHED_RUNS:
+                    self.cache.clear()
+                self.cache[run] = fixed
+            if fixed is not None:
+                write(view[pos:m.start()])
+                write(fixed)
+                pos = m.end()
+                self.changes_made += 1
+        write(view[pos:limit])
+        return limit
+
+def partial_suffix(buf, pos, end, token):
+    # Length of the longest start of token that buf[pos:end] ends with, 0 if none.
+    for length in range(min(len(token) - 1, end - pos), 0, -1):
+        if buf[end - length:end] == token[:length]:
+            return length
+    return 0
+
+def fix_entity_run(run):
+    # The bytes to write for a run of numeric entities, or None to keep the run as is.
+    out = []
+    changed = False
+    entities = ENTITY.findall(run)
+    values = [int(digits, 16 if hex_prefix else 10) for hex_prefix, digits in entities]
+    i = 0
+    while i < len(values):
+        value = values[i]
+        if 0xD800 <= value <= 0xDBFF and i + 1 < len(values) and 0xDC00 <= values[i + 1] <= 0xDFFF:
+            code_point = 0x10000 + ((value - 0xD800) << 10) + (values[i + 1] - 0xDC00)
+            out.append(chr(code_point).encode("utf-8"))
+            changed = True
+            i += 2
+            continue
+        if 0xD800 <= value <= 0xDFFF:
+            out.append(REPLACEMENT_CHARACTER)
+            changed = True
+        else:
+            hex_prefix, digits = entities[i]
+            out.append(b"&#" + hex_prefix + digits + b";")
+        i += 1
+    return b"".join(out) if changed else None
+
+def feed_range(fixer, mm, start, end, window, write, progress=None):
+    # Feed mm[start:end] to fixer a window at a time; end is treated as the end of input.
+    pos = start
+    step = window
+    while pos < end:
+        stop = min(pos + step, end)
+        consumed = fixer.feed(mm, pos, stop, stop == end, write)
+        # An entity run longer than the window is only cut off; widen the window until it fits
+        step = window if consumed > pos else step * 2
+        pos = consumed
+        if progress is not None:
+            progress(pos)
+
+def fix_file_bytes(input_file, output_file, total_size, chunk_size_kb=None, jobs=1):
+    # Byte engine: maps the input file and feeds it to a ByteEntityFixer in large
+    # windows, writing unchanged stretches straight from the mapping. Returns the
+    # number of entity runs fixed.
+    window = (chunk_size_kb or DEFAULT_WINDOW_KB) * 1024
+    with open(input_file, 'rb') as inputFile, open(output_file, 'wb', buffering=1024 * 1024) as outputFile:
+        if total_size == 0:
+            return 0
+        with mmap.mmap(inputFile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            if jobs > 1:
+                return fix_chunks_parallel(input_file, mm, outputFile, total_size, window, jobs)
+            fixer = ByteEntityFixer()
+            feed_range(fixer, mm, 0, total_size, window, outputFile.write,
+                       lambda pos: print_progress_bar(pos, total_size))
+            return fixer.changes_made
+
+def iter_cdata_spans(mm):
+    # Yields (start, end) of each CDATA section, end being just after its "]]>", or the
+    # end of the file for one that is never closed.
+    pos = 0
+    while True:
+        start = mm.find(CDATA_START, pos)
+        if start < 0:
+            return
+        close = mm.find(CDATA_END, start + len(CDATA_START))
+        end = len(mm) if close < 0 else close + len(CDATA_END)
+        yield start, end
+        pos = end
+
+def split_chunks(mm, total_size, chunk_size):
+    # Offsets where the file can be cut into chunks of about chunk_size bytes that the
+    # byte engine can fix on their own. Each cut is just before a "<", which can't be
+    # part of an entity run, and outside any CDATA section, so a chunk starts with the
+    # same state as the serial engine has there and its end is a real end of input.
+    cuts = [0]
+    spans = iter_cdata_spans(mm)
+    span = next(spans, None)
+    pos = chunk_size
+    while pos < total_size:
+        cut = mm.find(b"<", pos)
+        if cut < 0:
+            break
+        while span is not None and span[1] <= cut:
+            span = next(spans, None)
+        if span is not None and span[0] < cut:
+            # Inside a CDATA section; cut right after it instead
+            cut = span[1]
+        if cut >= total_size:
+            break
+        cuts.append(cut)
+        pos = cut + chunk_size
+    cuts.append(total_size)
+    return list(zip(cuts, cuts[1:]))
+
+def fix_chunk(input_file, start, end, window):
+    # Worker process: fixes one chunk. Returns (changes made, fixed bytes), with None
+    # instead of the bytes if nothing changed, as the main process can copy the chunk
+    # from its own mapping.
+    fixer = ByteEntityFixer()
+    out = io.BytesIO()
+    with open(input_file, 'rb') as inputFile, mmap.mmap(inputFile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        feed_range(fixer, mm, start, end, window, out.write)
+    if not fixer.changes_made:
+        return 0, None
+    return fixer.changes_made, out.getvalue()
+
+def fix_chunks_parallel(input_file, mm, outputFile, total_size, window, jobs):
+    # --jobs: fixes the chunks from split_chunks in a pool of worker processes and writes
+    # the results in file order, so the output is the same as with the serial engine.
+    chunks = split_chunks(mm, total_size, window)
+    changes_made = 0
+    # A few chunks queued per worker keeps them busy while bounding memory use
+    max_pending = 2 * jobs
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        executor = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('forkserver'))
+    else:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+    with executor:
+        pending = deque()
+        for start, end in chunks:
+            pending.append((start, end, executor.submit(fix_chunk, input_file, start, end, window)))
+            if len(pending) >= max_pending:
+                changes_made += write_chunk(mm, outputFile, total_size, *pending.popleft())
+        while pending:
+            changes_made += write_chunk(mm, outputFile, total_size, *pending.popleft())
+    return changes_made
+
+def write_chunk(mm, outputFile, total_size, start, end, future):
+    # Write the result of fix_chunk for mm[start:end]. Returns the changes made.
+    changes, fixed = future.result()
+    if fixed is None:
+        with memoryview(mm) as view:
+            outputFile.write(view[start:end])
+    else:
+        outputFile.write(fixed)
+    print_progress_bar(end, total_size)
+    return changes
+
+def is_utf8(encoding):
+    return codecs.lookup(encoding).name == 'utf-8'
+
+def process_file(input_file, output_file, chunk_size_kb=None, input_encoding='utf-8', output_encoding='utf-8', engine='bytes', jobs=1):
     # Process an XML file and fix numeric XML entities in the file.
     start_time = time.time()
-    # Convert chunk_size_kb to bytes.
-    chunk_size = chunk_size_kb * 1024
     total_size = os.path.getsize(input_file)
-    processed_size = 0
-    changes_made = 0
+    if engine == 'bytes' and not (is_utf8(input_encoding) and is_utf8(output_encoding)):
+        print("The bytes engine only reads and writes UTF-8; using the text engine")
+        engine = 'text'
     try:
-        # Open input and output files.
-        with open(input_file, 'r', encoding=input_encoding) as inputFile, open(output_file, "w", encoding=output_encoding) as outputFile:
-            leftover = ''
-            while True:
-                # Read a chunk of the input file.
-                raw_chunk = leftover + inputFile.read(chunk_size)
-                if not raw_chunk:
-                    break
-                
-                # Update the processed size and print the progress bar.
-                processed_size += len(raw_chunk.encode(input_encoding)) - len(leftover.encode(input_encoding))
-                print_progress_bar(processed_size, total_size)
-                
-                # Check if the chunk ends with an incomplete XML entity or CDATA section.
-                incomplete_entity = re.search(r'&#[0-9]*$|<!\[CDATA\[.*', raw_chunk)
-                if incomplete_entity:
-                    # Move the incomplete XML entity or CDATA section to the next chunk.
-                    leftover = incomplete_entity.group()
-                    raw_chunk = raw_chunk[:incomplete_entity.start()]
-                else:
-                    leftover = ''
-                
-                # Fix the numeric XML entities in the chunk.
-                sanitized_chunk = fix_codepoints(raw_chunk, raw=True)
-                if sanitized_chunk != raw_chunk:
-                    changes_made += 1
-                # Write the processed chunk to the output file.
-                outputFile.write(sanitized_chunk)
+        if engine == 'bytes':
+            changes_made = fix_file_bytes(input_file, output_file, total_size, chunk_size_kb, jobs)
+        else:
+            chunk_size_kb = chunk_size_kb or 64
+            changes_made = fix_file_text(input_file, output_file, total_size, chunk_size_kb, input_encoding, output_encoding)
 
         end_time = time.time()
         runtime = end_time - start_time
@@ -100,8 +327,9 @@ def process_file(input_file, output_file, chunk_size_kb=64, input_encoding='utf-
         # Print summary statistics.
         print("\n\n---- Summary ----")
         print("Runtime: {:.2f} seconds".format(runtime))
+        print("Engine: {}".format(engine if engine == 'text' or jobs <= 1 else "bytes, {} jobs".format(jobs)))
         print("Changes Made: {}".format(changes_made))
-        print("Chunk Size: {} KB".format(chunk_size_kb))
+        print("Chunk Size: {} KB".format(chunk_size_kb or DEFAULT_WINDOW_KB))
         print("Input File Size: {:.2f} MB".format(total_size / (1024 * 1024)))
         print("Output File Size: {:.2f} MB".format(os.path.getsize(output_file) / (1024 * 1024)))
     except FileNotFoundError as e:
@@ -111,19 +339,63 @@ def process_file(input_file, output_file, chunk_size_kb=64, input_encoding='utf-
     except Exception as e:
         print(f"\nError: {e}")
 
+def fix_file_text(input_file, output_file, total_size, chunk_size_kb=64, input_encoding='utf-8', output_encoding='utf-8'):
+    # Text engine: decodes the input and fixes it a chunk at a time with fix_codepoints.
+    # Returns the number of chunks changed.
+    # Convert chunk_size_kb to bytes.
+    chunk_size = chunk_size_kb * 1024
+    processed_size = 0
+    changes_made = 0
+    # Open input and output files.
+    with open(input_file, 'r', encoding=input_encoding) as inputFile, open(output_file, "w", encoding=output_encoding) as outputFile:
+        leftover = ''
+        while True:
+            # Read a chunk of the input file.
+            raw_chunk = leftover + inputFile.read(chunk_size)
+            if not raw_chunk:
+                break
+            
+            # Update the processed size and print the progress bar.
+            processed_size += len(raw_chunk.encode(input_encoding)) - len(leftover.encode(input_encoding))
+            print_progress_bar(processed_size, total_size)
+            
+            # Check if the chunk ends with an incomplete XML entity or CDATA section.
+            incomplete_entity = re.search(r'&#[0-9]*$|<!\[CDATA\[.*', raw_chunk)
+            if incomplete_entity:
+                # Move the incomplete XML entity or CDATA section to the next chunk.
+                leftover = incomplete_entity.group()
+                raw_chunk = raw_chunk[:incomplete_entity.start()]
+            else:
+                leftover = ''
+            
+            # Fix the numeric XML entities in the chunk.
+            sanitized_chunk = fix_codepoints(raw_chunk, raw=True)
+            if sanitized_chunk != raw_chunk:
+                changes_made += 1
+            # Write the processed chunk to the output file.
+            outputFile.write(sanitized_chunk)
+
+    return changes_made
+
 
 def main():
     # Define command line arguments.
     parser = argparse.ArgumentParser(description="Process and fix XML entities in a file.")
     parser.add_argument("input_file", help="Input file path")
     parser.add_argument("output_file", help="Output file path")
-    parser.add_argument("--chunk-size", type=int, default=64, help="Chunk size in KB (default: 64KB)")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="Chunk size in KB (default: 16384KB for the bytes engine, 64KB for the text engine)")
+    parser.add_argument("--engine", choices=['bytes', 'text'], default='bytes',
+                        help="bytes: fix surrogate pair entities in the raw UTF-8 bytes (default); "
+                             "text: decode the input and replace every numeric entity, as earlier versions did")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of processes fixing chunks of the file in parallel, bytes engine only (default: 1)")
     parser.add_argument("--input-encoding", default='utf-8', help="Encoding of the input file")
     parser.add_argument("--output-encoding", default='utf-8', help="Encoding of the output file")
 
     # Parse command line arguments and process the file.
     args = parser.parse_args()
-    process_file(args.input_file, args.output_file, args.chunk_size, args.input_encoding, args.output_encoding)
+    process_file(args.input_file, args.output_file, args.chunk_size, args.input_encoding, args.output_encoding, args.engine, args.jobs)
 
 if __name__ == "__main__":
     main()
@@ -1,117 +1,558 @@
 import argparse
+import base64
+import binascii
+import hashlib
+import heapq
 import logging
+import mmap
+import multiprocessing
 import os
+import pickle
+import re
 import sqlite3
-import xml.etree.ElementTree as ET
+import tempfile
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+
+from lxml import etree
 
 # Initialize Logging
 logging.basicConfig(level=logging.ERROR)
 
 # Constants
+# A record is a duplicate if it has the same address, date and content hash as one
+# already stored. The hash is over the message content only (see get_content_hash),
+# so the one unique index stays small however large the MMS bodies are.
 SQL_CREATE_SMS_TABLE = '''CREATE TABLE IF NOT EXISTS sms_data (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        address TEXT,
-                        date TEXT,
-                        xml_data TEXT UNIQUE)'''
+                        address TEXT NOT NULL,
+                        date TEXT NOT NULL,
+                        content_hash BLOB NOT NULL,
+                        xml_data TEXT)'''
 
-SQL_CREATE_SEEN_TABLE = '''CREATE TABLE IF NOT EXISTS seen_records (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        address TEXT,
-                        date TEXT,
-                        UNIQUE (address, date))'''
+SQL_CREATE_KEY_INDEX = '''CREATE UNIQUE INDEX IF NOT EXISTS sms_data_key
+                        ON sms_data (address, date, content_hash)'''
+
+SQL_INSERT = 'INSERT OR IGNORE INTO sms_data (address, date, content_hash, xml_data) VALUES (?, ?, ?, ?)'
+
+# MMS part payloads are stored once per content, as raw bytes. In xml_data the part's
+# data attribute then holds BLOB_REF_PREFIX and the hex SHA256 of its base64 text,
+# which write_to_output puts back. Only payloads in canonical base64 are stored this
+# way, so the text and the bytes identify each other. ':' is not a base64 character,
+# so a reference can't be mistaken for an inline payload.
+SQL_CREATE_BLOB_TABLE = '''CREATE TABLE IF NOT EXISTS part_blobs (
+                        id INTEGER PRIMARY KEY,
+                        sha256 BLOB NOT NULL UNIQUE,
+                        compression INTEGER NOT NULL,
+                        data BLOB NOT NULL)'''
+
+SQL_INSERT_BLOB = 'INSERT OR IGNORE INTO part_blobs (sha256, compression, data) VALUES (?, ?, ?)'
+
+BLOB_REF_PREFIX = 'blob:'
+BLOB_REF = re.compile(r' data="blob:([0-9a-f]{64})"')
+
+# part_blobs.compression values
+BLOB_RAW = 0
+BLOB_ZLIB = 1
+
+# Payloads are base64-encoded for output in chunks of this many bytes (a multiple of 3)
+BASE64_CHUNK = 3 * 1024 * 1024
+
+# Digests of the blobs this process has already returned in a row. A payload seen
+# again only needs a reference, without being decoded. Cleared when it reaches
+# MAX_EMITTED_BLOBS entries to bound its memory.
+emitted_blobs = set()
+MAX_EMITTED_BLOBS = 1000000
+
+# Specify the batch size for batch insert, and the number of records per transaction.
+# A batch is also flushed once its records reach BATCH_BYTES, as MMS records with
+# video attachments can be tens of MB each.
+BATCH_SIZE = 10000  # Adjust this as needed
+BATCH_BYTES = 32 * 1024 * 1024
+COMMIT_SIZE = 200000
+
+# With --workers, input files are split into shards of about this many bytes,
+# each parsed by a worker process. Shards start at a record, so one can be larger.
+SHARD_SIZE = 16 * 1024 * 1024
+
+# Matches the start tag of an <sms> or <mms> record. A literal '<' can't occur in
+# attribute values or text, so this only finds real records.
+RECORD_START = re.compile(rb'<(?:sms|mms)[\s/>]')
+
+# SQLite page cache, in KiB (negative cache_size values are KiB)
+CACHE_SIZE_KB = 256 * 1024
+
+# --stream-merge: records are sorted in memory in runs of about this many bytes and
+# spilled to temporary files, which are then merged at most MERGE_FAN_IN at a time.
+RUN_BYTES = 64 * 1024 * 1024
+MERGE_FAN_IN = 64
 
-# Specify the batch size for batch insert
-BATCH_SIZE = 1000  # Adjust this as needed
+# Width of the <smses count="N"> start tag written before the count is known; it is
+# padded with spaces and rewritten in place at the end.
+COUNT_TAG_WIDTH = 40
 
-def setup_db(conn):
+def setup_db(conn, sync_mode='NORMAL', blob_level=0):
     """Initialize the SQLite database."""
     cursor = conn.cursor()
+    # WAL only applies to database files; in-memory databases ignore it
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=%s' % sync_mode)
+    cursor.execute('PRAGMA cache_size=%d' % -CACHE_SIZE_KB)
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute(SQL_CREATE_BLOB_TABLE)
+    if needs_migration(conn):
+        migrate_db(conn, blob_level)
     cursor.execute(SQL_CREATE_SMS_TABLE)
-    cursor.execute(SQL_CREATE_SEEN_TABLE)
+    cursor.execute(SQL_CREATE_KEY_INDEX)
     conn.commit()
 
-def batch_insert(conn, data_batch):
-    """Inserts records in batches."""
+def needs_migration(conn):
+    """Databases from earlier versions have no content_hash column."""
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(sms_data)')]
+    return bool(columns) and 'content_hash' not in columns
+
+def migrate_db(conn, blob_level=0):
+    """Move records from the earlier schema (xml_data TEXT UNIQUE plus a seen_records
+    table) to the keyed table, keeping their order. Part payloads move to part_blobs."""
+    logging.warning("Upgrading the database to the new schema, this may take a while")
     cursor = conn.cursor()
-    cursor.executemany('INSERT OR IGNORE INTO sms_data (address, date, xml_data) VALUES (?, ?, ?)', data_batch)
-    cursor.executemany('INSERT OR IGNORE INTO seen_records (address, date) VALUES (?, ?)', [(x[0], x[1]) for x in data_batch])
+    cursor.execute('ALTER TABLE sms_data RENAME TO sms_data_old')
+    cursor.execute(SQL_CREATE_SMS_TABLE)
+    cursor.execute(SQL_CREATE_KEY_INDEX)
+    inserter = BatchInserter(conn)
+    # These records were read from a backup once already, so their size is not checked again
+    parser = etree.XMLParser(huge_tree=True)
+    for address, date, xml_data in conn.execute('SELECT address, date, xml_data FROM sms_data_old ORDER BY id'):
+        try:
+            elem = etree.fromstring(xml_data, parser)
+        except etree.XMLSyntaxError as e:
+            logging.error(f"Skipping unreadable record {address} {date}: {e}")
+            continue
+        inserter.add(get_stored_row(elem, blob_level))
+    inserter.flush()
+    cursor.execute('DROP TABLE sms_data_old')
+    cursor.execute('DROP TABLE IF EXISTS seen_records')
     conn.commit()
+    # Give back the space of the old full-text unique index
+    conn.execute('VACUUM')
 
-def read_and_insert_xml(conn, file_name, use_iterparse=False):
-    """Reads XML data and inserts it into the database."""
-    data_batch = []
-    cursor = conn.cursor()
+def get_content_hash(elem):
+    """Hash of what a message says: the SMS body, or the type, text and data of each
+    MMS part. Attributes that change between backups (read status, readable_date...)
+    are left out, so the same message from two backups has the same hash."""
+    h = hashlib.blake2b(digest_size=16)
+    if elem.tag == 'sms':
+        h.update(b'sms\0')
+        h.update((elem.get('body') or '').encode('utf-8'))
+    else:
+        h.update(b'mms\0')
+        for part in elem.iter('part'):
+            for attr in ('ct', 'text', 'data'):
+                h.update((part.get(attr) or '').encode('utf-8'))
+                h.update(b'\0')
+    return h.digest()
+
+def get_record_row(elem, xml_data):
+    """Row to insert for a record. Missing keys are stored as empty strings, as NULLs
+    never count as duplicates in a unique index."""
+    return (elem.get('address') or '', elem.get('date') or '', get_content_hash(elem), xml_data)
+
+def is_canonical_base64(data, payload):
+    """Whether encoding payload gives data back. data has already been decoded with
+    validate=True, so only its length and the bits of the last group can differ;
+    this avoids encoding large payloads a second time."""
+    if len(data) != (len(payload) + 2) // 3 * 4:
+        return False
+    tail = len(payload) % 3 or 3
+    return base64.b64encode(payload[-tail:]).decode('ascii') == data[-4:]
+
+def get_stored_row(elem, blob_level=0):
+    """Row to insert for a record, with the payload of each MMS part moved out of the
+    XML into a (sha256, compression, data) blob. With blob_level 1 to 9, payloads are
+    compressed with zlib at that level when it makes them smaller."""
+    row = get_record_row(elem, None)
+    blobs = []
+    for part in elem.iter('part'):
+        data = part.get('data')
+        if not data:
+            continue
+        digest = hashlib.sha256(data.encode('utf-8')).digest()
+        if digest in emitted_blobs:
+            part.set('data', BLOB_REF_PREFIX + digest.hex())
+            continue
+        try:
+            payload = base64.b64decode(data, validate=True)
+        except binascii.Error:
+            continue
+        if not is_canonical_base64(data, payload):
+            # write_to_output would not give back the same text, keep it inline
+            continue
+        compression = BLOB_RAW
+        if blob_level:
+            compressed = zlib.compress(payload, blob_level)
+            if len(compressed) < len(payload):
+                payload, compression = compressed, BLOB_ZLIB
+        blobs.append((digest, compression, payload))
+        if len(emitted_blobs) >= MAX_EMITTED_BLOBS:
+            emitted_blobs.clear()
+        emitted_blobs.add(digest)
+        part.set('data', BLOB_REF_PREFIX + digest.hex())
+    xml_data = etree.tostring(elem, encoding='unicode', with_tail=False)
+    return row[:3] + (xml_data, blobs)
+
+class BatchInserter:
+    """Collects rows and inserts them with INSERT OR IGNORE, committing every
+    COMMIT_SIZE rows so the inserts run in large transactions. Rows from
+    get_stored_row also carry the blobs of their parts."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.data_batch = []
+        self.blob_batch = []
+        self.batch_bytes = 0
+        self.uncommitted = 0
+
+    def add(self, row):
+        self.data_batch.append(row[:4])
+        self.batch_bytes += len(row[3])
+        if len(row) > 4:
+            for blob in row[4]:
+                self.blob_batch.append(blob)
+                self.batch_bytes += len(blob[2])
+        if len(self.data_batch) >= BATCH_SIZE or self.batch_bytes >= BATCH_BYTES:
+            self.flush()
+
+    def flush(self):
+        if self.blob_batch:
+            self.conn.executemany(SQL_INSERT_BLOB, self.blob_batch)
+            self.blob_batch = []
+        if self.data_batch:
+            self.conn.executemany(SQL_INSERT, self.data_batch)
+            self.uncommitted += len(self.data_batch)
+            self.data_batch = []
+            self.batch_bytes = 0
+        if self.uncommitted >= COMMIT_SIZE:
+            self.commit()
+
+    def commit(self):
+        self.flush()
+        self.conn.commit()
+        self.uncommitted = 0
+
+def release_record(elem):
+    """Frees a processed record along with any earlier siblings, so the tree built
+    by iterparse does not keep growing."""
+    elem.clear()
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
 
-    if use_iterparse:
-        # Initialize variables to keep track of the currently processed elements and text
-        current_elem = None
-        current_address = None
-        current_date = None
-
-        for event, elem in ET.iterparse(file_name, events=("start", "end")):
-            if event == "start":
-                if elem.tag in ['sms', 'mms']:
-                    current_elem = elem
-                    current_address = elem.get('address')
-                    current_date = elem.get('date')
-            elif event == "end":
-                if elem.tag in ['sms', 'mms']:
-                    xml_data = ET.tostring(current_elem, encoding='unicode')
-                    
-                    cursor.execute('SELECT 1 FROM seen_records WHERE address=? AND date=?', (current_address, current_date))
-                    if cursor.fetchone() is None:
-                        data_batch.append((current_address, current_date, xml_data))
-
-                    if len(data_batch) >= BATCH_SIZE:
-                        batch_insert(conn, data_batch)
-                        data_batch = []
-
-                    # Clean up memory as elements are processed
-                    elem.clear()
+def iter_records(source, huge_tree=False, blob_level=None):
+    """Yields a row for each <sms> and <mms> record in source, a file name or a
+    binary file object. With blob_level None part payloads stay in the XML, otherwise
+    rows come from get_stored_row."""
+    for _, elem in etree.iterparse(source, tag=('sms', 'mms'), huge_tree=huge_tree):
+        if blob_level is None:
+            # with_tail=False leaves out the whitespace that follows the record
+            xml_data = etree.tostring(elem, encoding='unicode', with_tail=False)
+            yield get_record_row(elem, xml_data)
+        else:
+            yield get_stored_row(elem, blob_level)
+        release_record(elem)
 
+def iter_file_rows(file_name, huge_tree=False, blob_level=None):
+    """Yields the rows of an XML file, stopping with an error logged if the file is
+    malformed."""
+    try:
+        yield from iter_records(file_name, huge_tree, blob_level)
+    except etree.XMLSyntaxError as e:
+        logging.error(f"Failed to parse {file_name}, keeping the records read before the error: {e}")
+
+def iter_input_rows(input_files, workers=1, huge_tree=False, blob_level=None):
+    """Yields the rows of all input files in input order, parsed here or, with more
+    than one worker, in a process pool."""
+    if workers > 1:
+        yield from iter_parallel_rows(input_files, workers, huge_tree, blob_level)
     else:
+        for input_file in input_files:
+            yield from iter_file_rows(input_file, huge_tree, blob_level)
+
+def read_and_insert_xml(conn, file_name, huge_tree=False, blob_level=0):
+    """Streams the records of an XML file into the database."""
+    inserter = BatchInserter(conn)
+    for row in iter_file_rows(file_name, huge_tree, blob_level):
+        inserter.add(row)
+    inserter.commit()
+
+def split_shards(file_name, shard_size=SHARD_SIZE):
+    """Splits the records of an XML file into (start, end) byte ranges of about
+    shard_size bytes, each starting at an <sms> or <mms> start tag."""
+    if os.path.getsize(file_name) == 0:
+        return []
+    with open(file_name, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        match = RECORD_START.search(mm)
+        if match is None:
+            return []
+        last = mm.rfind(b'</smses>')
+        if last < match.start():
+            last = len(mm)
+        shards = []
+        start = match.start()
+        while start < last:
+            match = RECORD_START.search(mm, start + shard_size, last) if start + shard_size < last else None
+            end = match.start() if match is not None else last
+            shards.append((start, end))
+            start = end
+        return shards
+
+class ShardReader:
+    """File object for iterparse that reads a byte range of a mapped file wrapped in
+    an <smses> element, so the range parses as a document of its own."""
+    def __init__(self, mm, start, end):
+        self.mm = mm
+        self.pos = start
+        self.end = end
+        self.pending = [b'<smses>']
+        self.closed = False
+
+    def read(self, size=-1):
+        if self.pending:
+            return self.pending.pop()
+        if self.pos >= self.end:
+            if self.closed:
+                return b''
+            self.closed = True
+            return b'</smses>'
+        stop = self.end if size < 0 else min(self.end, self.pos + size)
+        data = self.mm[self.pos:stop]
+        self.pos = stop
+        return data
+
+def parse_shard(file_name, start, end, huge_tree=False, blob_level=None):
+    """Worker process: returns (rows, error message or None) for one shard."""
+    rows = []
+    with open(file_name, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
         try:
-            tree = ET.parse(file_name)
-        except ET.ParseError as e:
-            logging.error(f"Failed to parse {file_name}: {e}")
-            return
+            for row in iter_records(ShardReader(mm, start, end), huge_tree, blob_level):
+                rows.append(row)
+        except etree.XMLSyntaxError as e:
+            return rows, str(e)
+    return rows, None
+
+def read_and_insert_parallel(conn, input_files, workers, huge_tree=False, blob_level=0):
+    """Parses the shards of all input files in a pool of worker processes, while
+    this process alone writes their records to the database. Results are taken in
+    input order, so the database ends up the same as with one worker."""
+    inserter = BatchInserter(conn)
+    for row in iter_parallel_rows(input_files, workers, huge_tree, blob_level):
+        inserter.add(row)
+    inserter.commit()
+
+def iter_parallel_rows(input_files, workers, huge_tree=False, blob_level=None):
+    """Yields the rows of all input files in input order, parsing their shards in a
+    pool of worker processes."""
+    tasks = [(file_name, start, end) for file_name in input_files for start, end in split_shards(file_name)]
+    # Keep a few shards queued per worker, so memory use does not depend on input size
+    max_pending = 2 * workers
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    # Files that failed to parse. As with one worker, the records after the first
+    # error in a file are dropped, so the shards that follow it are discarded.
+    failed = set()
+    with executor:
+        pending = deque()
+        for task in tasks:
+            if task[0] in failed:
+                continue
+            pending.append((task, executor.submit(parse_shard, *task, huge_tree, blob_level)))
+            if len(pending) >= max_pending:
+                yield from get_shard_rows(*pending.popleft(), failed)
+        while pending:
+            yield from get_shard_rows(*pending.popleft(), failed)
+
+def get_shard_rows(task, future, failed):
+    """Returns the rows of a finished shard, logging its parse error if any and
+    adding its file to failed. Shards of files already in failed yield nothing."""
+    file_name, start, end = task
+    if file_name in failed:
+        future.cancel()
+        return []
+    rows, error = future.result()
+    if error is not None:
+        failed.add(file_name)
+        logging.error(f"Failed to parse {file_name} between bytes {start} and {end}, "
+                      f"keeping the records read before the error: {error}")
+    return rows
+
+def get_sort_key(row):
+    """Sort and deduplication key of a row: date as a number, then address and
+    content hash, so records with the same key end up next to each other."""
+    address, date, content_hash, _ = row
+    try:
+        timestamp = int(date)
+    except ValueError:
+        timestamp = -1
+    return (timestamp, address, content_hash)
 
-        root = tree.getroot()
-        for tag_name in ['sms', 'mms']:
-            for elem in root.findall(tag_name):
-                address = elem.get('address')
-                date = elem.get('date')
-                xml_data = ET.tostring(elem, encoding='unicode')
+def spill_run(rows, spill_dir, number):
+    """Sorts a run of rows and writes it to a spill file as (key, xml_data) pickles."""
+    rows.sort(key=get_sort_key)
+    path = os.path.join(spill_dir, 'run-%06d' % number)
+    with open(path, 'wb') as f:
+        for row in rows:
+            pickle.dump((get_sort_key(row), row[3]), f, pickle.HIGHEST_PROTOCOL)
+    return path
 
-                cursor.execute('SELECT 1 FROM seen_records WHERE address=? AND date=?', (address, date))
-                if cursor.fetchone() is None:
-                    data_batch.append((address, date, xml_data))
+def iter_run(path):
+    """Yields the (key, xml_data) records of a spill file."""
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
 
-                if len(data_batch) >= BATCH_SIZE:
-                    batch_insert(conn, data_batch)
-                    data_batch = []
+def iter_unique(records):
+    """Drops (key, xml_data) records with the same key as the one before."""
+    last_key = None
+    for key, xml_data in records:
+        if key != last_key:
+            last_key = key
+            yield key, xml_data
 
-    if data_batch:
-        batch_insert(conn, data_batch)
+def merge_runs(paths):
+    """Merges sorted spill files into one deduplicated stream. heapq.merge keeps
+    equal keys in run order, so the first input wins, as with the database."""
+    return iter_unique(heapq.merge(*[iter_run(path) for path in paths], key=itemgetter(0)))
+
+def reduce_runs(paths, spill_dir):
+    """Merges consecutive groups of spill files until at most MERGE_FAN_IN are left,
+    so the final merge doesn't hold too many files open."""
+    number = len(paths)
+    while len(paths) > MERGE_FAN_IN:
+        merged = []
+        for i in range(0, len(paths), MERGE_FAN_IN):
+            group = paths[i:i + MERGE_FAN_IN]
+            if len(group) == 1:
+                merged.extend(group)
+                continue
+            path = os.path.join(spill_dir, 'run-%06d' % number)
+            number += 1
+            with open(path, 'wb') as f:
+                for record in merge_runs(group):
+                    pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+            for old_path in group:
+                os.remove(old_path)
+            merged.append(path)
+        paths = merged
+    return paths
+
+def stream_merge(input_files, output_file, workers=1, huge_tree=False, temp_dir=None):
+    """Writes the records of all input files ordered by date and deduplicated,
+    without a database: an external merge sort over runs spilled to temp_dir."""
+    with tempfile.TemporaryDirectory(prefix='merge-', dir=temp_dir) as spill_dir:
+        paths = []
+        rows = []
+        run_bytes = 0
+        for row in iter_input_rows(input_files, workers, huge_tree):
+            rows.append(row)
+            run_bytes += len(row[3])
+            if run_bytes >= RUN_BYTES:
+                paths.append(spill_run(rows, spill_dir, len(paths)))
+                rows = []
+                run_bytes = 0
+        if not paths:
+            # Everything fit in one run, nothing to spill. The sort is stable, so
+            # the first input still wins.
+            rows.sort(key=get_sort_key)
+            write_records(output_file, iter_unique((get_sort_key(row), row[3]) for row in rows))
+            return
+        if rows:
+            paths.append(spill_run(rows, spill_dir, len(paths)))
+        write_records(output_file, merge_runs(reduce_runs(paths, spill_dir)))
+
+def format_count_tag(count):
+    return ('<smses count="%d"' % count).ljust(COUNT_TAG_WIDTH - 2).encode('ascii') + b'>\n'
+
+def write_records(output_file, records):
+    """Writes (key, xml_data) records to an XML file in one pass. The count is
+    filled in at the end, as it is only known once all records are written."""
+    try:
+        with open(output_file, 'wb') as f:
+            f.write(b'<?xml version="1.0" encoding="UTF-8" ?>\n')
+            count_offset = f.tell()
+            f.write(format_count_tag(0))
+            count = 0
+            for _, xml_data in records:
+                f.write(xml_data.encode('utf-8'))
+                f.write(b'\n')
+                count += 1
+            f.write(b'</smses>')
+            f.seek(count_offset)
+            f.write(format_count_tag(count))
+    except IOError as e:
+        logging.error(f"File I/O error: {e}")
+        raise
 
 def write_to_output(conn, output_file):
-    """Writes database records to an XML file."""
+    """Writes database records to an XML file, putting the part payloads back in
+    as they are written."""
     try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write('<?xml version="1.0" encoding="UTF-8" ?>\n')
-            f.write('<smses>\n')
+        with open(output_file, 'wb') as f:
+            f.write(b'<?xml version="1.0" encoding="UTF-8" ?>\n')
+            count = conn.execute('SELECT COUNT(*) FROM sms_data').fetchone()[0]
+            f.write(f'<smses count="{count}">\n'.encode('ascii'))
             
             cursor = conn.cursor()
-            for row in cursor.execute('SELECT xml_data FROM sms_data'):
-                xml_data = row[0]
-                f.write(xml_data)
-                f.write("\n")
+            for row in cursor.execute('SELECT xml_data FROM sms_data ORDER BY id'):
+                write_xml_data(f, conn, row[0])
+                f.write(b"\n")
             
-            f.write('</smses>')
+            f.write(b'</smses>')
     except IOError as e:
         logging.error(f"File I/O error: {e}")
         raise
 
+def write_xml_data(f, conn, xml_data):
+    """Writes a stored record, replacing each blob reference with the base64 text
+    of the payload."""
+    pos = 0
+    for match in BLOB_REF.finditer(xml_data):
+        f.write(xml_data[pos:match.start()].encode('utf-8'))
+        f.write(b' data="')
+        write_blob(f, conn, bytes.fromhex(match.group(1)))
+        f.write(b'"')
+        pos = match.end()
+    f.write(xml_data[pos:].encode('utf-8'))
+
+def write_blob(f, conn, digest):
+    """Writes a payload from part_blobs as base64, a chunk at a time."""
+    row = conn.execute('SELECT compression, data FROM part_blobs WHERE sha256=?', (digest,)).fetchone()
+    if row is None:
+        logging.error(f"Missing attachment {digest.hex()}, written as empty")
+        return
+    compression, payload = row
+    if compression == BLOB_ZLIB:
+        payload = zlib.decompress(payload)
+    view = memoryview(payload)
+    for i in range(0, len(view), BASE64_CHUNK):
+        f.write(base64.b64encode(view[i:i + BASE64_CHUNK]))
+
+def get_input_files(input_items):
+    """Expands directories in the input list to the .xml files they contain."""
+    input_files = []
+    for input_item in input_items:
+        if os.path.isdir(input_item):
+            for root, dirs, files in os.walk(input_item):
+                input_files.extend([os.path.join(root, file) for file in files if file.endswith('.xml')])
+        else:
+            input_files.append(input_item)
+    return input_files
+
 def main():
     parser = argparse.ArgumentParser(description="Process XML files and store into SQLite")
     parser.add_argument("-i", "--input", type=str, nargs='+', help="Input XML files or SQLite DB", required=True)
@@ -119,6 +560,18 @@ def main():
     parser.add_argument("--db-file", type=str, help="SQLite DB file to store data", default=":memory:")
     parser.add_argument("--db-only-write", action="store_true", help="Only write to the SQLite DB, do not generate output XML")
     parser.add_argument("--input-db", action="store_true", help="Use SQLite DB as input for generating output XML")
+    parser.add_argument("--huge-tree", action="store_true",
+                        help="Disable lxml's limits on text size, needed for backups with very large attachments")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes parsing the input files (default: 1)")
+    parser.add_argument("--stream-merge", action="store_true",
+                        help="Merge the input files into an output ordered by date without a database, using temporary spill files")
+    parser.add_argument("--temp-dir", type=str, default=None,
+                        help="Folder for the --stream-merge spill files (default: the system temporary folder)")
+    parser.add_argument("--compress-level", type=int, choices=range(0, 10), default=0, metavar="{0-9}",
+                        help="zlib level for attachments stored in the database, 0 to store them uncompressed (default: 0)")
+    parser.add_argument("--sync-mode", type=str.upper, choices=['OFF', 'NORMAL', 'FULL'], default='NORMAL',
+                        help="SQLite synchronous mode (default: NORMAL)")
     
     args = parser.parse_args()
 
@@ -128,28 +581,29 @@ def main():
     if args.input_db and args.db_only_write:
         raise ValueError("Can't specify both --input-db and --db-only-write")
 
+    if args.stream_merge:
+        if not args.output:
+            raise ValueError("--stream-merge needs -o")
+        if args.input_db or args.db_only_write or args.db_file != ":memory:":
+            raise ValueError("--stream-merge doesn't use a database, so it can't be combined with --db-file, --input-db or --db-only-write")
+        stream_merge(get_input_files(args.input), args.output, args.workers, huge_tree=args.huge_tree, temp_dir=args.temp_dir)
+        return
+
     try:
         with sqlite3.connect(args.db_file) as conn:
-            setup_db(conn)
-            
-            # Determine whether to use iterparse based on the database file location
-            use_iterparse = bool(args.db_file and args.db_file != ":memory:")
+            setup_db(conn, args.sync_mode, args.compress_level)
 
             if args.input_db:
                 if args.output:
                     write_to_output(conn, args.output)
             else:
-                input_files = []
-                for input_item in args.input:
-                    if os.path.isdir(input_item):
-                        for root, dirs, files in os.walk(input_item):
-                            input_files.extend([os.path.join(root, file) for file in files if file.endswith('.xml')])
-                    else:
-                        input_files.append(input_item)
-
-                # This loop now exists within the scope where input_files is defined.
-                for input_file in input_files:
-                    read_and_insert_xml(conn, input_file, use_iterparse=use_iterparse)
+                input_files = get_input_files(args.input)
+                if args.workers > 1:
+                    read_and_insert_parallel(conn, input_files, args.workers, huge_tree=args.huge_tree,
+                                             blob_level=args.compress_level)
+                else:
+                    for input_file in input_files:
+                        read_and_insert_xml(conn, input_file, huge_tree=args.huge_tree, blob_level=args.compress_level)
 
                 if args.output and not args.db_only_write:
                     write_to_output(conn, args.output)